@@ -1,30 +1,40 @@
 from datetime import datetime
+import hashlib
 import json
 import logging
 import os
 import re
+import threading
+import time
 import traceback
 
 from dotenv import load_dotenv
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, g, render_template, request, jsonify
 from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
-from langchain_anthropic import ChatAnthropic
-from langchain.schema import HumanMessage
-from sqlalchemy import text
+from sqlalchemy import create_engine, text
+
+from async_logging import setup_logging
+from message_journal import MessageJournal
+from name_index import NameIndex, NameIndexCache, category_terms, resolve_names
+from metrics import observe_request, render_metrics
+from result_cache import ResultCache
+from result_encoder import compact_result
+from result_formatter import format_locally
+from schema_prompt import SchemaPrompt
+from session_memory import SessionMemory
 
 # initialize database object
 db = SQLAlchemy()
 
-# Set up logging configuration
-logging.basicConfig(
-    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
-)
-logger = logging.getLogger(__name__)
-
 # Load environment variables
 load_dotenv()
 
+# Set up logging configuration, records are written by a background thread
+# and large payloads are sampled and truncated, see async_logging.py
+setup_logging()
+logger = logging.getLogger(__name__)
+
 # Check if ANTHROPIC_API_KEY is set
 if not os.getenv("ANTHROPIC_API_KEY"):
     logger.warning("WARNING: ANTHROPIC_API_KEY is not set!")
@@ -37,26 +47,138 @@ app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv(
 )
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
+# "anthropic" for Claude, "stub" for the canned local responses in bench/stub_llm.py
+app.config["LLM_BACKEND"] = os.getenv("LLM_BACKEND", "anthropic")
+app.config["LLM_STUB_LATENCY"] = float(os.getenv("LLM_STUB_LATENCY", "0.5"))
+app.config["LLM_STUB_TOKEN_DELAY"] = float(os.getenv("LLM_STUB_TOKEN_DELAY", "0.0"))
+
+# Result cache configuration for repeated /chat questions
+app.config["RESULT_CACHE_MAX_ENTRIES"] = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "256"))
+app.config["RESULT_CACHE_TTL_SECONDS"] = int(os.getenv("RESULT_CACHE_TTL_SECONDS", "900"))
+
+# Bounds for queries generated by Claude
+app.config["QUERY_MAX_ROWS"] = int(os.getenv("QUERY_MAX_ROWS", "500"))
+app.config["QUERY_FETCH_BATCH_SIZE"] = int(os.getenv("QUERY_FETCH_BATCH_SIZE", "200"))
+app.config["QUERY_SUMMARY_ON_TRUNCATE"] = os.getenv("QUERY_SUMMARY_ON_TRUNCATE", "true").lower() == "true"
+
+# Query governor, see query_governor.py. Generated queries run on their own small
+# read-only pool so a runaway query can't take connections from the rest of the app.
+app.config["QUERY_DATABASE_URL"] = os.getenv("QUERY_DATABASE_URL", app.config["SQLALCHEMY_DATABASE_URI"])
+app.config["QUERY_POOL_SIZE"] = int(os.getenv("QUERY_POOL_SIZE", "5"))
+app.config["QUERY_POOL_MAX_OVERFLOW"] = int(os.getenv("QUERY_POOL_MAX_OVERFLOW", "5"))
+app.config["QUERY_POOL_TIMEOUT"] = int(os.getenv("QUERY_POOL_TIMEOUT", "10"))
+app.config["QUERY_STATEMENT_TIMEOUT_MS"] = int(os.getenv("QUERY_STATEMENT_TIMEOUT_MS", "15000"))
+app.config["QUERY_MAX_COST"] = float(os.getenv("QUERY_MAX_COST", "1000000"))
+
+# Where generated queries run: "postgres" or "duckdb" for the in-process DuckDB backend over
+# the pipeline's Parquet output or database file, see duckdb_backend.py. Chat history stays in Postgres.
+app.config["QUERY_BACKEND"] = os.getenv("QUERY_BACKEND", "postgres")
+app.config["DUCKDB_SOURCE"] = os.getenv("DUCKDB_SOURCE", "/app/data/static/clustered_customers.parquet")
+app.config["DUCKDB_TABLE"] = os.getenv("DUCKDB_TABLE", "clustered_customers")
+app.config["DUCKDB_THREADS"] = int(os.getenv("DUCKDB_THREADS", "0")) or None
+app.config["DUCKDB_MEMORY_LIMIT"] = os.getenv("DUCKDB_MEMORY_LIMIT")
+
+# Encoding of query results in the analysis prompt, see result_encoder.py
+app.config["RESULT_ENCODER"] = os.getenv("RESULT_ENCODER", "table")
+app.config["RESULT_TOKEN_BUDGET"] = int(os.getenv("RESULT_TOKEN_BUDGET", "2000"))
+
+# Results whose shape is in LOCAL_FORMAT_SHAPES are answered from a template instead of
+# a second Claude call, see result_formatter.py. Requests can override this with "local_format".
+app.config["LOCAL_FORMAT_ENABLED"] = os.getenv("LOCAL_FORMAT_ENABLED", "true").lower() == "true"
+app.config["LOCAL_FORMAT_SHAPES"] = tuple(
+    shape.strip() for shape in os.getenv("LOCAL_FORMAT_SHAPES", "empty,scalar,single_row").split(",")
+)
+
+# Schema sent to Claude: "file" reads schema.json, "catalog" uses the live customer_data columns
+app.config["SCHEMA_PATH"] = os.getenv("SCHEMA_PATH", "/app/data/static/schema.json")
+app.config["SCHEMA_SOURCE"] = os.getenv("SCHEMA_SOURCE", "file")
+
+# Fuzzy matching of customer names in questions to exact names before the SQL is
+# generated, see name_index.py. Matches scoring below NAME_MATCH_MIN_SCORE are ignored, matches
+# covering less than NAME_MATCH_MIN_NAME_COVERAGE of the name are only suggested, not filtered on.
+app.config["NAME_INDEX_ENABLED"] = os.getenv("NAME_INDEX_ENABLED", "true").lower() == "true"
+app.config["NAME_MATCH_MIN_SCORE"] = float(os.getenv("NAME_MATCH_MIN_SCORE", "0.75"))
+app.config["NAME_MATCH_MIN_NAME_COVERAGE"] = float(os.getenv("NAME_MATCH_MIN_NAME_COVERAGE", "0.5"))
+
+# Page sizes for /history
+app.config["HISTORY_PAGE_SIZE"] = int(os.getenv("HISTORY_PAGE_SIZE", "50"))
+app.config["HISTORY_MAX_PAGE_SIZE"] = int(os.getenv("HISTORY_MAX_PAGE_SIZE", "200"))
+
+# Recent turns of each chat session kept in memory for follow-up questions
+app.config["SESSION_MEMORY_MAX_SESSIONS"] = int(os.getenv("SESSION_MEMORY_MAX_SESSIONS", "1000"))
+app.config["SESSION_MEMORY_MAX_TURNS"] = int(os.getenv("SESSION_MEMORY_MAX_TURNS", "6"))
+
+# Concurrency and size limits for /chat/batch and batch_questions.py
+app.config["BATCH_MAX_WORKERS"] = int(os.getenv("BATCH_MAX_WORKERS", "8"))
+app.config["BATCH_MAX_QUESTIONS"] = int(os.getenv("BATCH_MAX_QUESTIONS", "200"))
+
+# Write-behind journal for chat messages, see message_journal.py
+app.config["MESSAGE_JOURNAL_ENABLED"] = os.getenv("MESSAGE_JOURNAL_ENABLED", "true").lower() == "true"
+app.config["MESSAGE_JOURNAL_MAX_SIZE"] = int(os.getenv("MESSAGE_JOURNAL_MAX_SIZE", "10000"))
+app.config["MESSAGE_JOURNAL_BATCH_SIZE"] = int(os.getenv("MESSAGE_JOURNAL_BATCH_SIZE", "100"))
+app.config["MESSAGE_JOURNAL_FLUSH_INTERVAL"] = float(os.getenv("MESSAGE_JOURNAL_FLUSH_INTERVAL", "0.05"))
+app.config["MESSAGE_JOURNAL_PUT_TIMEOUT"] = float(os.getenv("MESSAGE_JOURNAL_PUT_TIMEOUT", "1.0"))
+# Failed batches are retried this long, then kept in the spill file until the database takes writes again
+app.config["MESSAGE_JOURNAL_RETRY_SECONDS"] = float(os.getenv("MESSAGE_JOURNAL_RETRY_SECONDS", "60"))
+app.config["MESSAGE_JOURNAL_SPILL_PATH"] = os.getenv("MESSAGE_JOURNAL_SPILL_PATH", "/app/data/message_journal_spill.jsonl")
+
 # Initialize extensions
 db.init_app(app)
 migrate = Migrate(app, db)
+result_cache = ResultCache(
+    max_entries=app.config["RESULT_CACHE_MAX_ENTRIES"],
+    ttl_seconds=app.config["RESULT_CACHE_TTL_SECONDS"],
+)
+schema_prompt = SchemaPrompt(app.config["SCHEMA_PATH"])
+name_index_cache = NameIndexCache()
+session_memory = SessionMemory(
+    max_sessions=app.config["SESSION_MEMORY_MAX_SESSIONS"],
+    max_turns=app.config["SESSION_MEMORY_MAX_TURNS"],
+)
+
+# The Claude client is built on first use, importing langchain_anthropic takes over a second
+_chat = None
+_chat_lock = threading.Lock()
+
+
+def get_chat():
+    global _chat
+    if _chat is None:
+        with _chat_lock:
+            if _chat is None:
+                if app.config["LLM_BACKEND"] == "stub":
+                    from bench.stub_llm import StubChat
+
+                    # Deterministic local stand-in used by the benchmarks
+                    _chat = StubChat(
+                        latency=app.config["LLM_STUB_LATENCY"],
+                        token_delay=app.config["LLM_STUB_TOKEN_DELAY"],
+                    )
+                else:
+                    from langchain_anthropic import ChatAnthropic
+
+                    # Initialize the ChatAnthropic instance
+                    _chat = ChatAnthropic(temperature=0.7, model="claude-3-sonnet-20240229")
+    return _chat
 
-# Create tables within app context
-with app.app_context():
-    db.create_all()
-    logger.info("Database tables created successfully")
 
-try:
-    # Initialize the ChatAnthropic instance
-    chat = ChatAnthropic(temperature=0.7, model="claude-3-sonnet-20240229")
-except Exception as e:
-    logger.error(f"Error initializing ChatAnthropic: {str(e)}")
-    traceback.print_exc()
+# Session of messages sent without a session_id
+DEFAULT_SESSION_ID = "default"
+SESSION_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
 
 
 # Database Models to store chat history
 class ChatMessage(db.Model):
+    # Follow-up context is read per session in timestamp order, /history pages per session by id
+    __table_args__ = (
+        db.Index("ix_chat_message_session_id_timestamp", "session_id", "timestamp"),
+        db.Index("ix_chat_message_session_id_id", "session_id", "id"),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(
+        db.String(64), nullable=False, default=DEFAULT_SESSION_ID, server_default=DEFAULT_SESSION_ID
+    )
     content = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     is_user = db.Column(db.Boolean, default=True)
@@ -65,59 +187,109 @@ class ChatMessage(db.Model):
     def to_dict(self):
         return {
             "id": self.id,
+            "session_id": self.session_id,
             "content": self.content,
             "timestamp": self.timestamp.isoformat() if self.timestamp else None,
             "is_user": self.is_user,
             "query_info": self.query_info,
         }
 
-def load_schema():
-    # Load Schema function used by chat endpoint to get the database schema to send to Claude
-    with open('/app/data/static/schema.json', 'r') as f:
-        return json.load(f)
-    
-@app.route("/chat", methods=["POST"])
-def chat_endpoint():
+
+
+# Version counter bumped by load_data.py every time a table is reloaded
+class DataVersion(db.Model):
+    table_name = db.Column(db.String(128), primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+    loaded_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+# Columns and indexes added after tables were first created, create_all doesn't alter existing tables
+STARTUP_MIGRATIONS = [
+    f"ALTER TABLE chat_message ADD COLUMN IF NOT EXISTS session_id VARCHAR(64) NOT NULL DEFAULT '{DEFAULT_SESSION_ID}'",
+    "CREATE INDEX IF NOT EXISTS ix_chat_message_session_id_timestamp ON chat_message (session_id, timestamp)",
+    "CREATE INDEX IF NOT EXISTS ix_chat_message_session_id_id ON chat_message (session_id, id)",
+]
+
+# Advisory lock held while migrating, so containers starting together don't race
+MIGRATION_LOCK_ID = 531020
+
+
+def init_db():
+    # Create missing tables and apply STARTUP_MIGRATIONS, safe to run on every start
+    with db.engine.begin() as connection:
+        postgres = connection.dialect.name == "postgresql"
+        if postgres:
+            connection.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+        db.metadata.create_all(connection)
+        if postgres:
+            for statement in STARTUP_MIGRATIONS:
+                connection.execute(text(statement))
+    logger.info("Database tables are up to date")
+
+
+@app.cli.command("init-db")
+def init_db_command():
     """
-    This endpoint handles the chat functionality.
-    The initial message is sent to Claude with the database schema.
-    Claude generates an SQL query.
-    SQL query will be ran on our Postgres database.
-    We will again send the results of the DB query and the user query back to Claude to generate a natural language analysis of the results.
-
-    If the user's message starts with "follow up:", it sends the user's message to Claude along with the last query info from the database.
-    Claude then generates a response to the user's message.
+    Create the database tables and apply startup migrations, run once before the workers start.
     """
-    try:
-        if not os.getenv("ANTHROPIC_API_KEY"):
-            raise ValueError("ANTHROPIC_API_KEY is not set")
-
-        user_message = request.json.get("message", "")
-        if not user_message:
-            return jsonify({"error": "No message provided"}), 400
-
-        logger.info(f"Received message: {user_message}")  # Debug log
-
-        # Check if this is a follow-up question
-        is_followup = user_message.lower().startswith("follow up:")
-        if is_followup:
-            # Remove the "follow up:" prefix
-            user_message = user_message[len("follow up:") :].strip()
-            # Get the last AI message and user message from the database
-            last_ai_message = (
-                ChatMessage.query.filter_by(is_user=False)
-                .order_by(ChatMessage.timestamp.desc())
-                .first()
-            )
-            last_user_message = (
-                ChatMessage.query.filter_by(is_user=True)
-                .order_by(ChatMessage.timestamp.desc())
-                .offset(1)
-                .first()
-            )
-
-            if last_ai_message and last_ai_message.query_info and last_user_message:
-                context = f"""Previous interaction:
+    init_db()
+
+
+def insert_messages(rows):
+    # Insert ChatMessage rows in one transaction, called by the journal writer thread
+    with app.app_context():
+        with db.engine.begin() as connection:
+            connection.execute(ChatMessage.__table__.insert(), rows)
+
+
+message_journal = MessageJournal(
+    insert_messages,
+    max_size=app.config["MESSAGE_JOURNAL_MAX_SIZE"],
+    batch_size=app.config["MESSAGE_JOURNAL_BATCH_SIZE"],
+    flush_interval=app.config["MESSAGE_JOURNAL_FLUSH_INTERVAL"],
+    put_timeout=app.config["MESSAGE_JOURNAL_PUT_TIMEOUT"],
+    retry_seconds=app.config["MESSAGE_JOURNAL_RETRY_SECONDS"],
+    spill_path=app.config["MESSAGE_JOURNAL_SPILL_PATH"],
+)
+
+
+def load_catalog_columns(table_name="customer_data"):
+    # Column names and types of the live table from the Postgres catalog
+    if duckdb_backend is not None:
+        return duckdb_backend.columns()
+    with db.engine.connect() as connection:
+        result = connection.execute(
+            text("""
+                SELECT column_name, data_type
+                FROM information_schema.columns
+                WHERE table_name = :table_name
+                ORDER BY ordinal_position
+            """),
+            {"table_name": table_name},
+        )
+        return [(row.column_name, row.data_type) for row in result]
+
+
+def load_schema():
+    # Load Schema function used by chat endpoint to get the database schema to send to Claude
+    # Returns the precompiled schema preamble and its hash, cached until the schema changes
+    if app.config["SCHEMA_SOURCE"] == "catalog":
+        return schema_prompt.get_from_catalog(get_data_version(), load_catalog_columns)
+    return schema_prompt.get()
+
+
+def get_data_version(table_name="customer_data"):
+    # Current load version of the table, 0 if it has never been loaded through load_data.py
+    if duckdb_backend is not None:
+        return duckdb_backend.data_version()
+    row = db.session.get(DataVersion, table_name)
+    return row.version if row else 0
+
+
+def build_followup_context(user_message, last_user_message, last_ai_message):
+    # Build the follow-up prompt from the last AI message and the user message that produced it
+    if last_ai_message and last_ai_message.query_info and last_user_message:
+        return f"""Previous interaction:
 Previous question: {last_user_message.content}
 Previous response: {last_ai_message.content}
 Previous query details: {last_ai_message.query_info}
@@ -125,183 +297,354 @@ Previous query details: {last_ai_message.query_info}
 User follow-up question: {user_message}
 
 Answer the follow-up question based on the previous interaction. Answer in the perspective of a sales analyst but don't say that 'As a sales analyst'."""
-            else:
-                context = f"User follow-up question (no previous context available): {user_message}"
-
-            # Save user message to database
-            db_user_message = ChatMessage(content=user_message, is_user=True)
-            db.session.add(db_user_message)
-            db.session.commit()
-
-            # Get response from Claude for follow-up
-            messages = [HumanMessage(content=context)]
-            response = chat.invoke(messages)
-            ai_response = response.content
-
-            # Save AI response to database with previous query info
-            db_ai_message = ChatMessage(
-                content=ai_response,
-                is_user=False,
-                query_info=last_ai_message.query_info if last_ai_message else None,
-            )
-            db.session.add(db_ai_message)
-            db.session.commit()
-
-            return jsonify(
-                {
-                    "response": ai_response,
-                    "query_info": last_ai_message.query_info
-                    if last_ai_message
-                    else None,
-                }
-            )
+    return f"User follow-up question (no previous context available): {user_message}"
 
-        else:
-            # Original SQL query handling code
-            schema = load_schema()
-            context = f"""I have a customer database with the following schema:
-{json.dumps(schema, indent=2)}
 
-When generating SQL queries:
-- Use the table name 'customer_data'
-- Follow the exact column names from the schema
-- For customer name searches, use case-insensitive pattern matching with: LOWER(customer_name) LIKE LOWER('%search_term%')
-- Return only the SQL query without additional explanation unless specifically asked
+def resolve_session_id(session_id):
+    # Session id sent by the client, the default session if none, None if it isn't valid
+    if not session_id:
+        return DEFAULT_SESSION_ID
+    if not isinstance(session_id, str) or not SESSION_ID_PATTERN.fullmatch(session_id):
+        return None
+    return session_id
+
+
+def load_distinct_values(column):
+    # Distinct non-null values of a customer_data column
+    if duckdb_backend is not None:
+        return duckdb_backend.distinct_values(column)
+    with query_engine.connect() as connection:
+        return connection.execute(
+            text(f"SELECT DISTINCT {column} FROM customer_data WHERE {column} IS NOT NULL")
+        ).scalars().all()
+
+
+def load_column_names():
+    # Column names of customer_data, read through the query engine so no app context is needed
+    if duckdb_backend is not None:
+        return [column for column, _ in duckdb_backend.columns()]
+    with query_engine.connect() as connection:
+        return list(connection.execute(text("SELECT * FROM customer_data LIMIT 0")).keys())
+
+
+# customer_data columns whose values a question can name instead of a customer
+NAME_INDEX_OTHER_COLUMNS = ["customer_state", "customer_city", "customer_member_type"]
+
+
+def build_name_index():
+    # Name index of the customer names, knowing the states, cities, member types and product
+    # categories a question can name
+    columns = load_column_names()
+    other_terms = category_terms(columns)
+    for column in NAME_INDEX_OTHER_COLUMNS:
+        if column in columns:
+            other_terms += load_distinct_values(column)
+    return NameIndex(load_distinct_values("customer_name"), other_terms=other_terms)
 
-For example, if searching for a customer named "westmount", the WHERE clause should be:
+
+def resolve_customer_names(user_message, data_version):
+    # Exact customer names the question mentions, [] if there are none or the index is unavailable
+    if not app.config["NAME_INDEX_ENABLED"]:
+        return []
+    try:
+        index = name_index_cache.get(data_version, build_name_index)
+    except Exception as e:
+        logger.error(f"Error building the customer name index: {str(e)}")
+        return []
+    return resolve_names(
+        index,
+        user_message,
+        min_score=app.config["NAME_MATCH_MIN_SCORE"],
+        min_name_coverage=app.config["NAME_MATCH_MIN_NAME_COVERAGE"],
+    )
+
+
+def sql_literal(value):
+    return "'" + value.replace("'", "''") + "'"
+
+
+def format_resolved_names(resolved_names):
+    # Prompt lines listing the exact customer names matched to the question, and the
+    # names only partly matching a mention as suggestions the query doesn't have to use
+    if not resolved_names:
+        return ""
+    lines = []
+    full = [match for match in resolved_names if not match.get("partial")]
+    partial = [match for match in resolved_names if match.get("partial")]
+    if full:
+        lines.append("Customer names in the question, matched to exact customer_name values:")
+        for match in full:
+            lines.append(f'- "{match["mention"]}": {", ".join(sql_literal(name) for name in match["names"])}')
+        lines.append(
+            "Filter on these with customer_name = '...' (customer_name IN (...) when a name has several matches) instead of LIKE."
+        )
+    if partial:
+        lines.append("Words in the question that are part of some customer names:")
+        for match in partial:
+            lines.append(f'- "{match["mention"]}": {", ".join(sql_literal(name) for name in match["names"])}')
+        lines.append(
+            "Only filter on these names when the question is about one of those customers, not when the words mean something else."
+        )
+    return "\n".join(lines) + "\n\n"
+
+
+def build_sql_context(schema_text, user_message, resolved_names=None):
+    # Prompt asking Claude to write the SQL query for the user's question
+    dialect = "- Write the query in DuckDB SQL\n" if duckdb_backend is not None else ""
+    # The LIKE guidance would compete with the exact names listed below, only give it without them
+    if any(not match.get("partial") for match in resolved_names or ()):
+        name_search = ""
+        example = ""
+    else:
+        name_search = "- For customer name searches, use case-insensitive pattern matching with: LOWER(customer_name) LIKE LOWER('%search_term%')\n"
+        example = """For example, if searching for a customer named "westmount", the WHERE clause should be:
 WHERE LOWER(customer_name) LIKE LOWER('%westmount%')
 
-User question: {user_message}"""
-
-            # Save user message to database
-            db_user_message = ChatMessage(content=user_message, is_user=True)
-            db.session.add(db_user_message)
-            db.session.commit()
-
-            # Get the response from Claude
-            messages = [HumanMessage(content=context)]
-            response = chat.invoke(messages)
-            logger.info(f"""
-API Call Log:
-User Message: {user_message}
-Context Sent: {context}
-API Response: {response.content}
-{'='*50}""")
-
-            ai_response = response.content
-            try:
-                # Extract SQL query using regex - looks for content between SELECT and semicolon
-                if "SELECT" in ai_response.upper():
-                    sql_match = re.search(
-                        r"(SELECT.*?;)", ai_response, re.IGNORECASE | re.DOTALL
-                    )
-                    if sql_match:
-                        sql_query = sql_match.group(1)
-                        with db.engine.connect() as connection:
-                            result = connection.execute(text(sql_query))
-                            # Get column names from result
-                            columns = result.keys()
-                            # Convert results to list of dicts
-                            query_result = [
-                                {col: value for col, value in zip(columns, row)}
-                                for row in result.fetchall()
-                            ]
-
-                            logger.info(
-                                f"Query executed successfully. Results: {query_result}"
-                            )
-
-                            followup_context = f"""Based on the user's question: "{user_message}"
+"""
+    return f"""I have a customer database with the following schema:
+{schema_text}
+
+When generating SQL queries:
+{dialect}- Use the table name 'customer_data', or one of the pre-aggregated views above when the question only needs totals by cluster, state or quarter
+- Follow the exact column names from the schema
+{name_search}- Return only the SQL query without additional explanation unless specifically asked
+
+{example}{format_resolved_names(resolved_names)}User question: {user_message}"""
+
+
+def extract_sql(ai_response):
+    # Extract SQL query using regex - looks for content between SELECT and semicolon
+    if "SELECT" not in ai_response.upper():
+        return None
+    sql_match = re.search(r"(SELECT.*?;)", ai_response, re.IGNORECASE | re.DOTALL)
+    return sql_match.group(1) if sql_match else None
+
+
+def create_query_engine():
+    # Pool for the generated queries, every transaction on it is read-only on Postgres
+    database_url = app.config["QUERY_DATABASE_URL"]
+    connect_args = {}
+    if database_url.startswith("postgresql"):
+        connect_args["options"] = "-c default_transaction_read_only=on"
+    return create_engine(
+        database_url,
+        pool_size=app.config["QUERY_POOL_SIZE"],
+        max_overflow=app.config["QUERY_POOL_MAX_OVERFLOW"],
+        pool_timeout=app.config["QUERY_POOL_TIMEOUT"],
+        pool_pre_ping=True,
+        connect_args=connect_args,
+    )
+
+
+query_engine = create_query_engine()
+
+
+def create_duckdb_backend():
+    # The in-process DuckDB backend when QUERY_BACKEND=duckdb, None for Postgres
+    if app.config["QUERY_BACKEND"] != "duckdb":
+        return None
+    from duckdb_backend import DuckDBBackend
+
+    return DuckDBBackend(
+        app.config["DUCKDB_SOURCE"],
+        table=app.config["DUCKDB_TABLE"],
+        threads=app.config["DUCKDB_THREADS"],
+        memory_limit=app.config["DUCKDB_MEMORY_LIMIT"],
+        max_rows=app.config["QUERY_MAX_ROWS"],
+        batch_size=app.config["QUERY_FETCH_BATCH_SIZE"],
+        summarize=app.config["QUERY_SUMMARY_ON_TRUNCATE"],
+        timeout_ms=app.config["QUERY_STATEMENT_TIMEOUT_MS"],
+    )
+
+
+duckdb_backend = create_duckdb_backend()
+
+
+def build_analysis_context(user_message, query_result):
+    # Prompt asking Claude to explain the query results, compacted to the token budget
+    encoded_result, stats = compact_result(
+        query_result,
+        token_budget=app.config["RESULT_TOKEN_BUDGET"],
+        encoder=app.config["RESULT_ENCODER"],
+    )
+    logger.info(f"Result encoding stats: {stats}")
+    return f"""Based on the user's question: "{user_message}"
                             
 Here are the query results:
-{json.dumps(query_result, indent=2)}
+{encoded_result}
 
 Please provide a natural language analysis of these results. Answer in the perspective of a sales analyst but don't say that 'As a sales analyst'."""
 
-                            # Send follow-up request to Claude
-                            followup_messages = [HumanMessage(content=followup_context)]
-                            followup_response = chat.invoke(followup_messages)
 
-                            # Log the follow-up interaction
-                            logger.info(f"""
-Follow-up API Call Log:
-Context: {followup_context}
-API Response: {followup_response.content}
-{'='*50}""")
+def local_format_requested(payload):
+    # Per-request "local_format" flag, LOCAL_FORMAT_ENABLED when not given
+    local_format = payload.get("local_format")
+    return app.config["LOCAL_FORMAT_ENABLED"] if local_format is None else bool(local_format)
+
+
+def analyze_locally(query_result, local_format):
+    # Template answer for trivial result shapes, None when Claude should analyze the result
+    if not local_format:
+        return None
+    return format_locally(query_result, app.config["LOCAL_FORMAT_SHAPES"])
+
+
+def cache_usable(cached, local_format):
+    # A cached template answer doesn't satisfy a request that asked for Claude's analysis
+    return cached is not None and (local_format or not cached.get("formatted_locally"))
+
+
+def timings_requested(payload, headers):
+    # Per-request "timings" flag or X-Timings header asking for the stage breakdown
+    return bool(payload.get("timings") or headers.get("X-Timings"))
+
 
-                            # Prepare the final response
-                            analysis = followup_response.content
-                            query_info = f"""Query Results:
-{json.dumps(query_result, indent=2)}
+def with_breakdown(response_data, timings, with_timings):
+    # Add the per-stage timings to the response when the client asked for them
+    if with_timings:
+        response_data["timings"] = timings.breakdown()
+    return response_data
+
+
+def format_query_info(query_result, sql_query):
+    # Query details stored with the AI message and shown in the query panel
+    return f"""Query Results:
+{json.dumps(query_result, indent=2, default=str)}
 
 SQL Query Used:
 {sql_query}"""
 
-                            # Save AI response to database
-                            db_ai_message = ChatMessage(
-                                content=analysis, is_user=False, query_info=query_info
-                            )
-                            db.session.add(db_ai_message)
-                            db.session.commit()
-
-                            return jsonify(
-                                {"response": analysis, "query_info": query_info}
-                            )
-            except Exception as e:
-                error_msg = f"\n\nError executing query: {str(e)}"
-                logger.error(f"""
-Error Log:
-{error_msg}
-{'='*50}""")
-                ai_response += error_msg
-                return jsonify({"response": ai_response})
-    except Exception as e:
-        logger.error(f"Error in chat endpoint: {str(e)}")
-        traceback.print_exc()
-        db.session.rollback()
-        return jsonify({"error": str(e)}), 500
-
 
 @app.route("/history", methods=["GET"])
 def get_history():
     """
-    This endpoint returns the chat history.
+    This endpoint returns a page of the chat history of one session, oldest message first.
+
+    Query parameters:
+    - session_id: the session to read, defaults to the default session
+    - before: only messages with an id lower than this, used to page back in time
+    - after: only messages with an id higher than this, used to poll for new messages
+    - limit: page size, defaults to HISTORY_PAGE_SIZE, between 1 and HISTORY_MAX_PAGE_SIZE
+    - include_query_info: "true" to include query_info, otherwise only has_query_info
+      is returned and the details are fetched from /history/<id>/query_info
+
+    Without before/after the latest page is returned. The X-Has-More header tells
+    whether more messages exist past this page in the paging direction (older for
+    before or no cursor, newer for after). Responses carry an ETag and a matching
+    If-None-Match gets a 304.
     """
     try:
-        messages = ChatMessage.query.order_by(ChatMessage.timestamp).all()
-
-        # Debug logging
-        logger.info(f"Found {len(messages)} messages in database")
-
-        history = []
-        for message in messages:
-            msg_dict = message.to_dict()
-            logger.info(f"Processing message: {msg_dict}")  # Debug log
-            history.append(msg_dict)
-
-        # Ensure we're returning a list
-        if not isinstance(history, list):
-            logger.warning(f"Warning: history is not a list, it's {type(history)}")
-            history = list(history)
-
-        logger.info(f"Returning history with {len(history)} messages")
-        return jsonify(history)
+        session_id = resolve_session_id(request.args.get("session_id"))
+        if session_id is None:
+            return jsonify({"error": "Invalid session_id"}), 400
+        before = request.args.get("before", type=int)
+        after = request.args.get("after", type=int)
+        limit = max(
+            min(
+                request.args.get("limit", app.config["HISTORY_PAGE_SIZE"], type=int),
+                app.config["HISTORY_MAX_PAGE_SIZE"],
+            ),
+            1,
+        )
+        include_query_info = request.args.get("include_query_info", "false").lower() == "true"
+
+        # Include messages still waiting in the journal
+        message_journal.flush()
+
+        # Only load query_info when asked for, it can be much larger than the message
+        columns = [
+            ChatMessage.id,
+            ChatMessage.content,
+            ChatMessage.timestamp,
+            ChatMessage.is_user,
+            ChatMessage.query_info.isnot(None).label("has_query_info"),
+        ]
+        if include_query_info:
+            columns.append(ChatMessage.query_info)
+
+        query = db.session.query(*columns).filter(ChatMessage.session_id == session_id)
+        if before is not None:
+            query = query.filter(ChatMessage.id < before)
+        if after is not None:
+            # Polling forward, page from the oldest new message
+            query = query.filter(ChatMessage.id > after).order_by(ChatMessage.id)
+        else:
+            query = query.order_by(ChatMessage.id.desc())
+        rows = query.limit(limit + 1).all()
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if after is None:
+            rows.reverse()
+
+        etag = hashlib.md5(
+            f"{[row.id for row in rows]}|{include_query_info}|{has_more}".encode("utf-8")
+        ).hexdigest()
+        if etag in request.if_none_match:
+            response = app.response_class(status=304)
+        else:
+            history = []
+            for row in rows:
+                message = {
+                    "id": row.id,
+                    "content": row.content,
+                    "timestamp": row.timestamp.isoformat() if row.timestamp else None,
+                    "is_user": row.is_user,
+                    "has_query_info": row.has_query_info,
+                }
+                if include_query_info:
+                    message["query_info"] = row.query_info
+                history.append(message)
+            logger.debug(f"Returning history page with {len(history)} messages")
+            response = jsonify(history)
+
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "no-cache"
+        response.headers["X-Has-More"] = "true" if has_more else "false"
+        return response
     except Exception as e:
         logger.error(f"Error fetching history: {str(e)}")
         traceback.print_exc()
         return jsonify([])  # Return empty array instead of error
 
 
+@app.route("/history/<int:message_id>/query_info", methods=["GET"])
+def get_message_query_info(message_id):
+    """
+    This endpoint returns the query_info of a single message, fetched lazily by the frontend.
+    The session_id query parameter is required, only messages of that session are returned.
+    """
+    if not request.args.get("session_id"):
+        return jsonify({"error": "session_id is required"}), 400
+    session_id = resolve_session_id(request.args.get("session_id"))
+    if session_id is None:
+        return jsonify({"error": "Invalid session_id"}), 400
+    message = (
+        db.session.query(ChatMessage.id, ChatMessage.query_info)
+        .filter(ChatMessage.id == message_id, ChatMessage.session_id == session_id)
+        .first()
+    )
+    if message is None:
+        return jsonify({"error": "Message not found"}), 404
+    return jsonify({"id": message.id, "query_info": message.query_info})
+
+
 @app.route("/reset", methods=["POST", "GET"])
 def reset_history():
     """
-    This endpoint clears the chat history.
+    This endpoint clears the chat history, of one session if a session_id is given.
     It is meant to be manually triggered.
     """
     try:
-        # Delete all messages
-        ChatMessage.query.delete()
+        session_id = request.args.get("session_id")
+        message_journal.flush()
+        if session_id:
+            ChatMessage.query.filter_by(session_id=session_id).delete()
+        else:
+            # Delete all messages
+            ChatMessage.query.delete()
         db.session.commit()
+        session_memory.clear(session_id or None)
         logger.info("Chat history cleared successfully")
         return jsonify({"message": "Chat history cleared successfully"})
     except Exception as e:
@@ -310,10 +653,102 @@ def reset_history():
         return jsonify({"error": str(e)}), 500
 
 
+def ping_database(engine):
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+
+
+def warm_up(check_database=True):
+    """
+    Build what the first request would otherwise wait for: database connections,
+    the schema preamble, the customer name index and the Claude client. Returns
+    {check: "ok" or the error}. With check_database=False nothing that queries
+    the database runs. Must be called within an app context.
+    """
+    steps = {
+        "schema": load_schema,
+        "llm_client": get_chat,
+    }
+    if not check_database and app.config["SCHEMA_SOURCE"] == "catalog":
+        # The catalog schema is read from the database
+        del steps["schema"]
+    if check_database:
+        steps = {
+            "database": lambda: ping_database(db.engine),
+            "query_database": lambda: (
+                duckdb_backend.ping() if duckdb_backend is not None else ping_database(query_engine)
+            ),
+            **steps,
+            "name_index": lambda: name_index_cache.get(get_data_version(), build_name_index),
+        }
+
+    checks = {}
+    for name, step in steps.items():
+        try:
+            step()
+            checks[name] = "ok"
+        except Exception as e:
+            logger.error(f"Warm-up step {name} failed: {str(e)}")
+            checks[name] = str(e)
+    return checks
+
+
+def reset_after_fork():
+    # Drop the pooled connections a forked worker inherited from the preloading parent
+    with app.app_context():
+        db.engine.dispose(close=False)
+    query_engine.dispose(close=False)
+    if duckdb_backend is not None:
+        duckdb_backend.reset()
+
+
+@app.route("/ready", methods=["GET"])
+def ready():
+    """
+    Readiness probe. The first call in a worker warms its database pools, schema
+    cache and Claude client, later calls are cheap. Returns 503 until every check is ok.
+    """
+    checks = warm_up()
+    ready = all(check == "ok" for check in checks.values())
+    return jsonify({"ready": ready, "checks": checks}), 200 if ready else 503
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    # Streamed responses are counted when their headers go out, not when the stream ends
+    if "request_start" in g:
+        observe_request(
+            request.endpoint or "unknown",
+            response.status_code,
+            time.perf_counter() - g.request_start,
+        )
+    return response
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    Prometheus metrics: per-stage durations, LLM prompt and response sizes,
+    query row counts, cache hits and request counts, see metrics.py.
+    """
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
+
+
 @app.route("/")
 def home():
     return render_template("index.html")
 
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    import uvicorn
+
+    with app.app_context():
+        init_db()
+    # The chat routes are served by the ASGI app, see asgi.py
+    uvicorn.run("asgi:application", port=5000, reload=True)
@@ -0,0 +1,216 @@
+"""
+ASGI entry point used by the production server.
+
+/chat, /chat/stream and /chat/batch run on the asyncio pipeline in
+chat_pipeline.py, so a request waiting on the LLM or the database doesn't hold
+a worker thread. The remaining routes (history, reset, readiness, metrics and
+the page itself) are served by the Flask app mounted underneath.
+
+Run with: gunicorn asgi:application -k uvicorn.workers.UvicornWorker
+"""
+import contextlib
+import functools
+import json
+import os
+import time
+import traceback
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+import chat_pipeline
+from app import (
+    app as flask_app,
+    local_format_requested,
+    logger,
+    resolve_session_id,
+    timings_requested,
+    with_breakdown,
+)
+from metrics import RequestTimings, observe_request
+
+# Streamed responses must reach the client as they are written, not buffered by a proxy
+STREAM_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+def sse_event(event, data):
+    # Format one Server-Sent Event frame
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+def observed(endpoint):
+    # Count requests to a route Flask's request hooks don't see. Streamed
+    # responses are counted when their headers go out, not when the stream ends
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def route(request):
+            start = time.perf_counter()
+            response = await handler(request)
+            observe_request(endpoint, response.status_code, time.perf_counter() - start)
+            return response
+
+        return route
+
+    return decorator
+
+
+async def read_json_object(request):
+    # (payload, None) for a body holding a JSON object, (None, error response) otherwise
+    try:
+        payload = await request.json()
+    except ValueError:
+        return None, JSONResponse({"error": "Request body must be valid JSON"}, status_code=400)
+    if not isinstance(payload, dict):
+        return None, JSONResponse({"error": "Request body must be a JSON object"}, status_code=400)
+    return payload, None
+
+
+async def read_chat_request(request):
+    # (payload, session_id, None) for a valid /chat or /chat/stream body, (None, None, error response) otherwise
+    if not os.getenv("ANTHROPIC_API_KEY"):
+        return None, None, JSONResponse({"error": "ANTHROPIC_API_KEY is not set"}, status_code=500)
+    payload, error = await read_json_object(request)
+    if error is not None:
+        return None, None, error
+    if not isinstance(payload.get("message", ""), str):
+        return None, None, JSONResponse({"error": "message must be a string"}, status_code=400)
+    if not payload.get("message", ""):
+        return None, None, JSONResponse({"error": "No message provided"}, status_code=400)
+    session_id = resolve_session_id(payload.get("session_id") or request.headers.get("X-Session-Id"))
+    if session_id is None:
+        return None, None, JSONResponse({"error": "Invalid session_id"}, status_code=400)
+    return payload, session_id, None
+
+
+@observed("chat_endpoint")
+async def chat_endpoint(request):
+    """
+    This endpoint handles the chat functionality.
+    The initial message is sent to Claude with the database schema.
+    Claude generates an SQL query.
+    SQL query will be ran on our Postgres database.
+    We will again send the results of the DB query and the user query back to Claude to generate a natural language analysis of the results.
+
+    If the user's message starts with "follow up:", it sends the user's message to Claude along with the last query info of the session.
+    Messages are stored under the session_id sent in the body or the X-Session-Id header, or the default session.
+    Claude then generates a response to the user's message.
+    """
+    try:
+        payload, session_id, error = await read_chat_request(request)
+        if error is not None:
+            return error
+        timings = RequestTimings()
+        logger.info(f"Received message: {payload['message']}")
+
+        async for event, data in chat_pipeline.answer_chat(
+            payload["message"], session_id, local_format_requested(payload), timings
+        ):
+            if event == "done":
+                response_data = data
+        return JSONResponse(
+            with_breakdown(response_data, timings, timings_requested(payload, request.headers))
+        )
+    except Exception as e:
+        logger.error(f"Error in chat endpoint: {str(e)}")
+        traceback.print_exc()
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+@observed("chat_stream_endpoint")
+async def chat_stream_endpoint(request):
+    """
+    Streaming version of /chat using Server-Sent Events.
+    Emits staged events as the pipeline progresses:
+    - status: the stage currently running
+    - sql: the SQL query generated by Claude
+    - rows: the query results as soon as the database returns them
+    - token: analysis text as Claude streams it
+    - done: the final response and query info
+    - error: the pipeline failed, the stream ends
+    """
+    payload, session_id, error = await read_chat_request(request)
+    if error is not None:
+        return error
+    timings = RequestTimings()
+    with_timings = timings_requested(payload, request.headers)
+    logger.info(f"Received streaming message: {payload['message']}")
+
+    async def generate():
+        try:
+            async for event, data in chat_pipeline.answer_chat(
+                payload["message"], session_id, local_format_requested(payload), timings, stream=True
+            ):
+                if event == "done":
+                    data = with_breakdown(data, timings, with_timings)
+                yield sse_event(event, data)
+        except Exception as e:
+            logger.error(f"Error in chat stream: {str(e)}")
+            traceback.print_exc()
+            yield sse_event("error", {"error": str(e)})
+
+    return StreamingResponse(generate(), media_type="text/event-stream", headers=STREAM_HEADERS)
+
+
+@observed("chat_batch_endpoint")
+async def chat_batch_endpoint(request):
+    """
+    This endpoint answers a list of questions concurrently, for report runs.
+
+    The body is {"questions": [...], "max_workers": optional, "local_format": optional}, max_workers
+    is kept between 1 and BATCH_MAX_WORKERS. Results are
+    streamed as newline-delimited JSON as each question finishes, one object
+    per question with its "index" in the list, "question", "response", "sql"
+    and "query_info", or "error". Identical questions and identical generated
+    SQL are only run once. Batch questions are not saved to the chat history.
+    """
+    if not os.getenv("ANTHROPIC_API_KEY"):
+        return JSONResponse({"error": "ANTHROPIC_API_KEY is not set"}, status_code=500)
+
+    payload, error = await read_json_object(request)
+    if error is not None:
+        return error
+    questions = payload.get("questions")
+    if not isinstance(questions, list) or not questions or not all(
+        isinstance(question, str) and question.strip() for question in questions
+    ):
+        return JSONResponse({"error": "questions must be a non-empty list of strings"}, status_code=400)
+    if len(questions) > flask_app.config["BATCH_MAX_QUESTIONS"]:
+        return JSONResponse(
+            {"error": f"At most {flask_app.config['BATCH_MAX_QUESTIONS']} questions per batch"},
+            status_code=400,
+        )
+
+    max_workers = payload.get("max_workers")
+    try:
+        max_workers = flask_app.config["BATCH_MAX_WORKERS"] if max_workers is None else int(max_workers)
+    except (TypeError, ValueError):
+        return JSONResponse({"error": "max_workers must be an integer"}, status_code=400)
+    max_workers = max(min(max_workers, flask_app.config["BATCH_MAX_WORKERS"]), 1)
+    logger.info(f"Received batch of {len(questions)} questions, {max_workers} workers")
+    results = chat_pipeline.answer_batch(questions, max_workers, local_format_requested(payload))
+
+    async def generate():
+        async for result in results:
+            yield json.dumps(result, default=str) + "\n"
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson", headers=STREAM_HEADERS)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    yield
+    # Write the queued messages before the worker exits
+    await chat_pipeline.close()
+
+
+application = Starlette(
+    routes=[
+        Route("/chat", chat_endpoint, methods=["POST"]),
+        Route("/chat/stream", chat_stream_endpoint, methods=["POST"]),
+        Route("/chat/batch", chat_batch_endpoint, methods=["POST"]),
+        Mount("/", app=WSGIMiddleware(flask_app)),
+    ],
+    lifespan=lifespan,
+)
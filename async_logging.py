@@ -0,0 +1,221 @@
+"""
+Logging that stays off the request path.
+
+setup_logging() routes every log record through a bounded in-process queue to a
+background thread that formats and writes it, so a request only pays for
+putting the record on the queue. When the queue is full records are dropped
+rather than making the request wait, and the writer reports how many it
+dropped.
+
+Prompts, LLM responses and other large payloads are logged with log_payload:
+- only a sample of them is logged (LOG_PAYLOAD_SAMPLE_RATE)
+- each field is truncated to its limit (LOG_FIELD_LIMITS, LOG_FIELD_LIMIT
+  for the rest) and any message to LOG_MAX_MESSAGE_CHARS
+- LOG_DEBUG_PAYLOADS=true logs every payload in full, for local debugging
+
+LOG_FORMAT=json writes one JSON object per line with the payload fields as
+keys, "text" keeps the "time - level - message" lines.
+"""
+import atexit
+from datetime import datetime, timezone
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def parse_field_limits(value):
+    # "prompt=2000,response=2000" -> {"prompt": 2000, "response": 2000}
+    limits = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            name, limit = item.split("=", 1)
+            limits[name.strip()] = int(limit)
+    return limits
+
+
+def truncate(value, limit):
+    if not isinstance(value, str):
+        value = str(value)
+    if limit is None or len(value) <= limit:
+        return value
+    return f"{value[:limit]}... [{len(value) - limit} more chars]"
+
+
+class PayloadSettings:
+    """
+    Sampling and truncation of the payloads passed to log_payload.
+    """
+
+    def __init__(self, sample_rate=0.01, field_limit=500, field_limits=None, debug=False):
+        self.sample_rate = sample_rate
+        self.field_limit = field_limit
+        self.field_limits = field_limits or {}
+        self.debug = debug
+
+    def sampled(self):
+        return self.debug or random.random() < self.sample_rate
+
+    def limit_for(self, field):
+        if self.debug:
+            return None
+        return self.field_limits.get(field, self.field_limit)
+
+
+payload_settings = PayloadSettings()
+
+
+def log_payload(log, event, level=logging.INFO, **fields):
+    """
+    Log a sampled, truncated record of a large payload (prompts, responses,
+    results). Nothing is formatted when the record isn't sampled.
+    """
+    if not log.isEnabledFor(level) or not payload_settings.sampled():
+        return
+    payload = {name: truncate(value, payload_settings.limit_for(name)) for name, value in fields.items()}
+    log.log(level, event, extra={"payload": payload})
+
+
+class JsonFormatter(logging.Formatter):
+    def __init__(self, max_message_chars=None):
+        super().__init__()
+        self.max_message_chars = max_message_chars
+
+    def format(self, record):
+        data = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": truncate(record.getMessage(), self.max_message_chars),
+        }
+        data.update(getattr(record, "payload", None) or {})
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self, max_message_chars=None):
+        super().__init__("%(asctime)s - %(levelname)s - %(message)s")
+        self.max_message_chars = max_message_chars
+
+    def formatMessage(self, record):
+        record.message = truncate(record.message, self.max_message_chars)
+        line = super().formatMessage(record)
+        payload = getattr(record, "payload", None)
+        if payload:
+            line += " " + json.dumps(payload, default=str)
+        return line
+
+
+class AsyncLogHandler(logging.Handler):
+    """
+    Hands records to a background thread that passes them to `target`.
+    """
+
+    def __init__(self, target, max_size=10000):
+        super().__init__()
+        self.target = target
+        self._queue = queue.Queue(maxsize=max_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._closed = False
+        self.dropped = 0
+        atexit.register(self.close)
+
+    def _ensure_started(self):
+        # Start the writer lazily, and again in a worker forked after it was started
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                if self._pid is not None and self._pid != os.getpid():
+                    # Records queued in the parent are its to write
+                    self._queue = queue.Queue(maxsize=self._queue.maxsize)
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="async-logging", daemon=True)
+                self._thread.start()
+
+    def emit(self, record):
+        if self._closed:
+            self.target.handle(record)
+            return
+        self._ensure_started()
+        try:
+            # The record is formatted by the writer thread, not here
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            self._queue.join()
+        self.target.flush()
+
+    def close(self):
+        """
+        Write everything still queued and stop the writer.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+        self.target.close()
+        super().close()
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            try:
+                if record is None:
+                    return
+                if self.dropped:
+                    dropped, self.dropped = self.dropped, 0
+                    self.target.handle(logger.makeRecord(
+                        logger.name, logging.WARNING, __file__, 0,
+                        f"Logging queue was full, dropped {dropped} log records", None, None,
+                    ))
+                self.target.handle(record)
+            except Exception:
+                self.handleError(record)
+            finally:
+                self._queue.task_done()
+
+
+def setup_logging():
+    """
+    Configure the root logger from the LOG_* environment variables and return
+    the AsyncLogHandler, or None with LOG_ASYNC=false.
+    """
+    max_message_chars = int(os.getenv("LOG_MAX_MESSAGE_CHARS", "2000")) or None
+    payload_settings.sample_rate = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.01"))
+    payload_settings.field_limit = int(os.getenv("LOG_FIELD_LIMIT", "500"))
+    payload_settings.field_limits = parse_field_limits(os.getenv("LOG_FIELD_LIMITS", "prompt=2000,response=2000"))
+    payload_settings.debug = os.getenv("LOG_DEBUG_PAYLOADS", "false").lower() == "true"
+    if payload_settings.debug:
+        max_message_chars = None
+
+    stream_handler = logging.StreamHandler(sys.stderr)
+    if os.getenv("LOG_FORMAT", "text") == "json":
+        stream_handler.setFormatter(JsonFormatter(max_message_chars))
+    else:
+        stream_handler.setFormatter(TextFormatter(max_message_chars))
+
+    handler = stream_handler
+    async_handler = None
+    if os.getenv("LOG_ASYNC", "true").lower() == "true":
+        async_handler = AsyncLogHandler(stream_handler, max_size=int(os.getenv("LOG_QUEUE_SIZE", "10000")))
+        handler = async_handler
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    return async_handler
@@ -0,0 +1,93 @@
+"""
+Concurrent answering of a batch of questions, used by /chat/batch and batch_questions.py.
+
+Questions run as asyncio tasks, at most max_workers at a time. Identical
+questions (after normalize_question) are answered once, and identical SQL
+generated for different questions is run once, at most max_query_workers
+queries at a time to stay within the query connection pool. Results are
+yielded as each question finishes, not in input order, each tagged with the
+index of its question.
+"""
+import asyncio
+
+from query_results import strip_sql
+from result_cache import normalize_question
+
+
+def normalize_sql(sql_query):
+    # Whitespace-insensitive key for deduplicating generated SQL, literals keep their case
+    return " ".join(strip_sql(sql_query).split())
+
+
+class SharedQueries:
+    """
+    Runs each distinct SQL query once, at most max_workers at a time, and
+    hands the same task to every question that generated it.
+    """
+
+    def __init__(self, run_query, max_workers):
+        self.run_query = run_query
+        self._semaphore = asyncio.Semaphore(max_workers)
+        self._tasks = {}
+
+    async def _run(self, sql_query):
+        async with self._semaphore:
+            return await self.run_query(sql_query)
+
+    def get(self, sql_query):
+        # An awaitable of the query result
+        key = normalize_sql(sql_query)
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._run(sql_query))
+            self._tasks[key] = task
+        return asyncio.shield(task)
+
+    def cancel(self):
+        for task in self._tasks.values():
+            task.cancel()
+
+    def __len__(self):
+        return len(self._tasks)
+
+
+async def run_batch(questions, answer, run_query, max_workers=8, max_query_workers=5):
+    """
+    Yield one result dict per question as soon as it is answered.
+
+    answer(question, queries) is a coroutine function returning a dict for one
+    question, it runs its SQL with await queries.get(sql). run_query is the
+    coroutine function running one query. Errors are returned as
+    {"error": ...} for that question and don't stop the batch.
+    """
+    unique = {}
+    for index, question in enumerate(questions):
+        unique.setdefault(normalize_question(question), []).append(index)
+
+    semaphore = asyncio.Semaphore(max_workers)
+    queries = SharedQueries(run_query, max_query_workers)
+
+    async def answer_one(question):
+        async with semaphore:
+            return await answer(question, queries)
+
+    pending = {
+        asyncio.ensure_future(answer_one(questions[indexes[0]])): indexes
+        for indexes in unique.values()
+    }
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                indexes = pending.pop(task)
+                try:
+                    result = task.result()
+                except Exception as e:
+                    result = {"error": str(e)}
+                for index in indexes:
+                    yield {"index": index, "question": questions[index], **result}
+    finally:
+        # Stop the remaining work if the consumer went away before the batch finished
+        for task in pending:
+            task.cancel()
+        queries.cancel()
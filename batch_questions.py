@@ -0,0 +1,65 @@
+"""
+Answer a list of questions concurrently and write the results as newline-delimited JSON.
+
+Usage: python batch_questions.py questions.txt [--workers 8] [--output results.ndjson]
+
+questions.txt holds one question per line, a .json file holds a list of questions.
+Results are written as each question finishes, see chat_pipeline.answer_batch.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+import chat_pipeline
+from app import app, logger
+
+
+def read_questions(path):
+    with open(path, "r") as f:
+        if path.endswith(".json"):
+            return json.load(f)
+        return [line.strip() for line in f if line.strip()]
+
+
+async def write_results(questions, workers, local_format, output):
+    # Write each result as it comes in and return the number of errors
+    errors = 0
+    try:
+        async for result in chat_pipeline.answer_batch(questions, workers, local_format):
+            errors += "error" in result
+            output.write(json.dumps(result, default=str) + "\n")
+            output.flush()
+    finally:
+        await chat_pipeline.close()
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a batch of questions concurrently")
+    parser.add_argument("questions", help="Text file with one question per line, or a JSON list")
+    parser.add_argument("--workers", type=int, default=app.config["BATCH_MAX_WORKERS"],
+                        help="Number of questions answered at the same time")
+    parser.add_argument("--output", help="NDJSON output file, stdout by default")
+    parser.add_argument("--no-local-format", action="store_true",
+                        help="Send every result to Claude for analysis, even single values")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    questions = read_questions(args.questions)
+    output = open(args.output, "w") if args.output else sys.stdout
+    start = time.perf_counter()
+    try:
+        local_format = False if args.no_local_format else None
+        errors = asyncio.run(write_results(questions, args.workers, local_format, output))
+    finally:
+        if args.output:
+            output.close()
+
+    logger.info(f"Answered {len(questions)} questions in {time.perf_counter() - start:.1f}s, {errors} errors")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Timings for the data pipelines on synthetic data.
+
+Usage: python -m bench.bench_pipelines [--files 10] [--rows-per-file 100000] [--new-files 1]
+                                       [--workdir /tmp/pipeline_bench] [--load] [--json results.json]
+
+Stages, each run as its own process the way they run in production:
+- generate          bench.generate_data writes the sales, customer and product files
+- ingest_full       IngestCustomerFiles.py --full over every sales file
+- ingest_incremental  IngestCustomerFiles.py after --new-files more sales files arrive
+- classify_fit      ClassifyModel.py fitting the clusters and writing clustered_customers.parquet
+- classify_score    ClassifyModel.py --score relabelling only the changed groups
+- load              load_data.py into DATABASE_URL, only with --load
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from bench.generate_data import generate
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+PIPELINES = os.path.join(ROOT, "data", "pipelines")
+
+
+def run_stage(name, command, cwd, env):
+    start = time.perf_counter()
+    completed = subprocess.run(command, cwd=cwd, env=env, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if completed.returncode != 0:
+        print(completed.stdout[-2000:])
+        print(completed.stderr[-2000:], file=sys.stderr)
+        raise SystemExit(f"Stage {name} failed with exit code {completed.returncode}")
+    print(f"{name:>20}: {elapsed:8.2f}s")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the DuckDB pipelines and load_data.py on synthetic data")
+    parser.add_argument("--workdir", default=os.path.join("/tmp", "pipeline_bench"))
+    parser.add_argument("--customers", type=int, default=5000)
+    parser.add_argument("--products", type=int, default=500)
+    parser.add_argument("--files", type=int, default=10)
+    parser.add_argument("--rows-per-file", type=int, default=100000)
+    parser.add_argument("--new-files", type=int, default=1, help="Sales files added before the incremental run")
+    parser.add_argument("--load", action="store_true", help="Also time load_data.py into DATABASE_URL")
+    parser.add_argument("--json", help="Also write the timings to this file")
+    args = parser.parse_args()
+
+    # Start from an empty database and only the sales files generated by this run
+    os.makedirs(args.workdir, exist_ok=True)
+    for name in ("my_database.db", "clustered_customers.parquet"):
+        if os.path.exists(os.path.join(args.workdir, name)):
+            os.remove(os.path.join(args.workdir, name))
+    sales_dir = os.path.join(args.workdir, "Sales")
+    if os.path.isdir(sales_dir):
+        for name in os.listdir(sales_dir):
+            os.remove(os.path.join(sales_dir, name))
+    env = {**os.environ, "DUCKDB_DATA_DIR": args.workdir}
+    sales_rows = args.files * args.rows_per_file
+
+    timings = {}
+    start = time.perf_counter()
+    generate(args.workdir, args.customers, args.products, args.files, args.rows_per_file)
+    timings["generate"] = time.perf_counter() - start
+    print(f"{'generate':>20}: {timings['generate']:8.2f}s ({sales_rows:,} sales rows)")
+
+    ingest = [sys.executable, os.path.join(PIPELINES, "IngestCustomerFiles.py")]
+    classify = [sys.executable, os.path.join(PIPELINES, "ClassifyModel.py")]
+
+    timings["ingest_full"] = run_stage("ingest_full", ingest + ["--full"], args.workdir, env)
+    timings["classify_fit"] = run_stage("classify_fit", classify, args.workdir, env)
+
+    generate(args.workdir, args.customers, args.products, args.new_files, args.rows_per_file,
+             first_file=args.files)
+    timings["ingest_incremental"] = run_stage("ingest_incremental", ingest, args.workdir, env)
+    timings["classify_score"] = run_stage("classify_score", classify + ["--score"], args.workdir, env)
+
+    if args.load:
+        timings["load"] = run_stage(
+            "load",
+            [sys.executable, os.path.join(ROOT, "load_data.py"),
+             os.path.join(args.workdir, "clustered_customers.parquet")],
+            ROOT,
+            env,
+        )
+
+    print(f"Full ingest: {sales_rows / timings['ingest_full']:,.0f} sales rows/sec")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"sales_rows": sales_rows, "seconds": timings}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
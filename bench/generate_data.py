@@ -0,0 +1,112 @@
+"""
+Synthetic sales, customer and product files in the layout IngestCustomerFiles.py reads.
+
+    <out>/Customers/CUSTOMER_DIM.csv
+    <out>/Products/product_category.csv
+    <out>/Sales/sales_<n>.csv        backtick delimited, dates as YYYY-MM-DD or MM/DD/YYYY
+
+Usage: python -m bench.generate_data <out> [--customers 5000] [--products 500]
+                                           [--files 10] [--rows-per-file 100000] [--seed 531]
+
+The same arguments always produce the same files. Point the pipeline at them with
+DUCKDB_DATA_DIR=<out>.
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+PRODUCT_CATEGORIES = [
+    "Infusion", "Infusion_Systems", "Vascular Access", "Oncology", "Other", "Veterinary",
+    "Service", "Critical Care", "Respiratory", "Solutions", "N/A",
+]
+MEMBER_TYPES = ["Hospital", "Clinic", "Pharmacy", "Distributor", "Veterinary"]
+STATES = ["CA", "TX", "NY", "FL", "IL", "PA", "OH", "GA", "NC", "MI", "ON", "QC", "BC"]
+
+
+def write_customers(out_dir, customers, rng):
+    keys = np.arange(customers)
+    states = rng.choice(STATES, customers)
+    frame = pd.DataFrame({
+        "CUSTOMER_COMPANY_KEY": keys,
+        "CUSTOMER_NAME": [f"C{key} - Company {key}" for key in keys],
+        "BACKEND_NAME": [f"Contact {key}" for key in keys],
+        "ADDRESS": [f"{key} Main St" for key in keys],
+        "CITY": [f"City {key % 400}" for key in keys],
+        "COUNTRY": np.where(np.isin(states, ["ON", "QC", "BC"]), "CA", "US"),
+        "STATE_PROV": states,
+        "MEMBER_INFO_TYPE": rng.choice(MEMBER_TYPES, customers),
+    })
+    os.makedirs(os.path.join(out_dir, "Customers"), exist_ok=True)
+    frame.to_csv(os.path.join(out_dir, "Customers", "CUSTOMER_DIM.csv"), index=False)
+
+
+def write_products(out_dir, products, rng):
+    keys = np.arange(products)
+    frame = pd.DataFrame({
+        "ITEM_COMPANY_KEY": keys,
+        "ITEM": [f"IT{key:06d}" for key in keys],
+        "ITEM_DESCRIPTION": [f"Item {key}" for key in keys],
+        "PRODUCT_TYPE": [f"Type {key % 40}" for key in keys],
+        "BACKEND_MARKET_SEGMENT_SE": rng.choice(PRODUCT_CATEGORIES, products),
+    })
+    os.makedirs(os.path.join(out_dir, "Products"), exist_ok=True)
+    frame.to_csv(os.path.join(out_dir, "Products", "product_category.csv"), index=False)
+
+
+def write_sales_file(path, rows, customers, products, rng, start="2022-01-01", days=3 * 365):
+    dates = pd.Timestamp(start) + pd.to_timedelta(rng.integers(0, days, rows), unit="D")
+    # Half the rows use the US date format, the pipeline has to parse both
+    us_format = rng.random(rows) < 0.5
+    activity_date = np.where(us_format, dates.strftime("%m/%d/%Y"), dates.strftime("%Y-%m-%d"))
+    frame = pd.DataFrame({
+        "NET_SALES_USD_BUDGET": np.round(rng.gamma(2.0, 250.0, rows), 2),
+        "NET_QTY_EACH": rng.integers(1, 50, rows),
+        "ACTIVITY_DATE": activity_date,
+        # A few large customers place most of the orders
+        "DIR_CUSTOMER_COMPANY_KEY": np.minimum(rng.zipf(1.3, rows) - 1, customers - 1),
+        "ITEM_COMPANY_KEY": rng.integers(0, products, rows),
+    })
+    frame.to_csv(path, sep="`", index=False)
+
+
+def generate(out_dir, customers=5000, products=500, files=10, rows_per_file=100000, seed=531, first_file=0):
+    """
+    Write the dimension files and sales files first_file..first_file+files-1.
+    Returns the number of sales rows written.
+    """
+    rng = np.random.default_rng(seed)
+    write_customers(out_dir, customers, rng)
+    write_products(out_dir, products, rng)
+
+    os.makedirs(os.path.join(out_dir, "Sales"), exist_ok=True)
+    for index in range(first_file, first_file + files):
+        # Each file has its own stream so adding files doesn't change the existing ones
+        file_rng = np.random.default_rng([seed, index])
+        write_sales_file(
+            os.path.join(out_dir, "Sales", f"sales_{index}.csv"), rows_per_file, customers, products, file_rng
+        )
+    return files * rows_per_file
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic sales, customer and product files")
+    parser.add_argument("out", help="Output folder, used as DUCKDB_DATA_DIR")
+    parser.add_argument("--customers", type=int, default=5000)
+    parser.add_argument("--products", type=int, default=500)
+    parser.add_argument("--files", type=int, default=10, help="Number of sales files")
+    parser.add_argument("--rows-per-file", type=int, default=100000)
+    parser.add_argument("--first-file", type=int, default=0, help="Index of the first sales file")
+    parser.add_argument("--seed", type=int, default=531)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    rows = generate(args.out, args.customers, args.products, args.files, args.rows_per_file, args.seed,
+                    args.first_file)
+    print(f"Wrote {rows:,} sales rows in {args.files} files to {args.out} in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
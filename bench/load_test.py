@@ -0,0 +1,271 @@
+"""
+Load scenarios for /chat, /chat/stream and /history reporting throughput and latency percentiles.
+
+Usage: python -m bench.load_test [chat|stream|history ...] [--requests 200] [--concurrency 10]
+                                 [--questions 50] [--url http://localhost:5001] [--json results.json]
+
+Without --url the ASGI app served in production (asgi.application) runs
+in-process on one event loop with the stub LLM (LLM_BACKEND=stub,
+LLM_STUB_LATENCY) against DATABASE_URL, a throwaway SQLite file by default
+(read through aiosqlite by the async pipeline).
+customer_data and the benchmark session's chat history are seeded with
+synthetic rows when missing. With --url requests go over HTTP to a running
+server, start it with LLM_BACKEND=stub to take Claude out of the numbers.
+
+--questions sets how many distinct questions /chat cycles through, so
+--questions equal to --requests means no result cache hits and a small number
+means mostly hits.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+BENCH_SESSION_ID = "bench"
+
+
+def percentile(sorted_values, p):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(name, latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    return {
+        "scenario": name,
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round((len(latencies) + errors) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "max_ms": round(latencies[-1] * 1000, 1) if latencies else 0.0,
+    }
+
+
+def print_report(results):
+    columns = ["scenario", "requests", "errors", "seconds", "throughput_rps", "p50_ms", "p95_ms", "p99_ms", "max_ms"]
+    print(" | ".join(f"{column:>14}" for column in columns))
+    for result in results:
+        print(" | ".join(f"{result[column]!s:>14}" for column in columns))
+
+
+class HttpClient:
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+
+    def request(self, method, path, payload=None, headers=None):
+        data = json.dumps(payload).encode("utf-8") if payload is not None else None
+        request = urllib.request.Request(self.base_url + path, data=data, method=method)
+        request.add_header("Content-Type", "application/json")
+        for name, value in (headers or {}).items():
+            request.add_header(name, value)
+        try:
+            with urllib.request.urlopen(request, timeout=300) as response:
+                return response.status, dict(response.headers), response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, dict(e.headers), e.read()
+
+
+class InProcessClient:
+    # Requests to the ASGI app on one event loop running in a background thread, like a uvicorn worker
+    def __init__(self, application):
+        import httpx
+
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name="bench-asgi", daemon=True).start()
+        self.client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=application), base_url="http://bench", timeout=300
+        )
+
+    def request(self, method, path, payload=None, headers=None):
+        response = asyncio.run_coroutine_threadsafe(
+            self.client.request(method, path, json=payload, headers=headers or {}), self.loop
+        ).result()
+        return response.status_code, response.headers, response.content
+
+
+def seed_customer_data(engine, rows, seed=531):
+    # Synthetic customer_data for the canned queries, only when the table doesn't exist yet
+    from sqlalchemy import inspect
+
+    if inspect(engine).has_table("customer_data"):
+        return
+    rng = np.random.default_rng(seed)
+    customers = max(rows // 12, 1)
+    frame = pd.DataFrame({
+        "customer_name": [f"Company {key}" for key in rng.integers(0, customers, rows)],
+        "customer_state": rng.choice(["CA", "TX", "NY", "FL", "IL", "ON"], rows),
+        "year": rng.integers(2022, 2025, rows),
+        "quarter": rng.integers(1, 5, rows),
+        "total_order_amount": np.round(rng.gamma(2.0, 5000.0, rows), 2),
+        "order_frequency": rng.integers(1, 100, rows),
+    })
+    frame.to_sql("customer_data", engine, index=False, chunksize=10000)
+    print(f"Seeded customer_data with {rows:,} rows")
+
+
+def seed_history(flask_app, messages):
+    # Chat history for the /history scenario in the benchmark session
+    from app import ChatMessage, db
+
+    with flask_app.app_context():
+        existing = ChatMessage.query.filter_by(session_id=BENCH_SESSION_ID).count()
+        if existing >= messages:
+            return
+        rows = [
+            {
+                "session_id": BENCH_SESSION_ID,
+                "content": f"Benchmark message {index}",
+                "is_user": index % 2 == 0,
+                "query_info": None if index % 2 == 0 else "Query Results:\n" + "x" * 2000,
+            }
+            for index in range(existing, messages)
+        ]
+        with db.engine.begin() as connection:
+            connection.execute(ChatMessage.__table__.insert(), rows)
+    print(f"Seeded {messages - existing:,} history messages")
+
+
+def run_scenario(name, client, requests, concurrency, make_request):
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def one(index):
+        nonlocal errors
+        start = time.perf_counter()
+        try:
+            ok = make_request(client, index)
+        except Exception as e:
+            print(f"{name} request {index} failed: {e}")
+            ok = False
+        elapsed = time.perf_counter() - start
+        with lock:
+            if ok:
+                latencies.append(elapsed)
+            else:
+                errors += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(requests)))
+    return summarize(name, latencies, errors, time.perf_counter() - start)
+
+
+def chat_request(questions, local_format):
+    def make_request(client, index):
+        payload = {
+            "message": f"What were the sales numbers for question {index % questions}?",
+            "session_id": f"bench-chat-{index % 16}",
+        }
+        if local_format is not None:
+            payload["local_format"] = local_format
+        status, _, body = client.request("POST", "/chat", payload)
+        return status == 200 and "error" not in json.loads(body)
+    return make_request
+
+
+def stream_request(questions):
+    def make_request(client, index):
+        payload = {
+            "message": f"Which customers stand out in question {index % questions}?",
+            "session_id": f"bench-stream-{index % 16}",
+        }
+        status, _, body = client.request("POST", "/chat/stream", payload)
+        return status == 200 and b"event: done" in body
+    return make_request
+
+
+def history_request(page_size):
+    latest = {}
+
+    def make_request(client, index):
+        # Alternate between the latest page, the page before it and a revalidation of the latest page
+        path = f"/history?session_id={BENCH_SESSION_ID}&limit={page_size}"
+        headers = {}
+        if index % 3 == 1 and "oldest_id" in latest:
+            path += f"&before={latest['oldest_id']}"
+        elif index % 3 == 2 and "etag" in latest:
+            headers["If-None-Match"] = latest["etag"]
+        status, response_headers, body = client.request("GET", path, headers=headers)
+        if index % 3 == 0 and status == 200:
+            page = json.loads(body)
+            latest["etag"] = response_headers.get("ETag")
+            if page:
+                latest["oldest_id"] = page[0]["id"]
+        return status in (200, 304)
+    return make_request
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test /chat, /chat/stream and /history")
+    parser.add_argument("scenarios", nargs="*", help="chat, stream and/or history, all three by default")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--questions", type=int, help="Distinct /chat questions, defaults to --requests")
+    parser.add_argument("--local-format", choices=["on", "off"], help="Send local_format with /chat requests")
+    parser.add_argument("--history-messages", type=int, default=5000, help="Messages seeded for /history")
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--customer-rows", type=int, default=100000, help="Rows seeded into customer_data")
+    parser.add_argument("--url", help="Base URL of a running server instead of the in-process app")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+    args.scenarios = args.scenarios or ["chat", "stream", "history"]
+    unknown = set(args.scenarios) - {"chat", "stream", "history"}
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    questions = args.questions or args.requests
+    local_format = None if args.local_format is None else args.local_format == "on"
+
+    if args.url:
+        client = HttpClient(args.url)
+    else:
+        os.environ.setdefault("LLM_BACKEND", "stub")
+        os.environ.setdefault("ANTHROPIC_API_KEY", "stub")
+        os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.gettempdir()}/chat_bench.db")
+        os.environ.setdefault(
+            "SCHEMA_PATH", os.path.join(os.path.dirname(__file__), "..", "data", "static", "schema.json")
+        )
+        from app import app as flask_app, db, init_db
+
+        with flask_app.app_context():
+            init_db()
+            seed_customer_data(db.engine, args.customer_rows)
+        if "history" in args.scenarios:
+            seed_history(flask_app, args.history_messages)
+        from asgi import application
+
+        client = InProcessClient(application)
+
+    scenarios = {
+        "chat": lambda: chat_request(questions, local_format),
+        "stream": lambda: stream_request(questions),
+        "history": lambda: history_request(args.page_size),
+    }
+    results = []
+    for name in args.scenarios:
+        results.append(run_scenario(name, client, args.requests, args.concurrency, scenarios[name]()))
+
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
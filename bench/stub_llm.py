@@ -0,0 +1,75 @@
+"""
+Deterministic local stand-in for ChatAnthropic.
+
+StubChat answers the SQL generation prompt with one of CANNED_SQL, picked by a
+hash of the prompt so the same question always gets the same query, and every
+other prompt with a fixed analysis. Each call sleeps for `latency` seconds and
+streaming sleeps `token_delay` between words, so benchmarks see LLM-like waits
+without network calls or cost.
+
+The app uses it when LLM_BACKEND=stub (LLM_STUB_LATENCY, LLM_STUB_TOKEN_DELAY).
+"""
+import asyncio
+import hashlib
+import time
+
+# Queries over customer_data covering the shapes the app sees: single values,
+# single rows, small groupings and large listings
+CANNED_SQL = [
+    "SELECT SUM(total_order_amount) AS total_order_amount FROM customer_data WHERE year = 2023 AND quarter = 3;",
+    "SELECT customer_name, year, quarter, total_order_amount FROM customer_data "
+    "WHERE LOWER(customer_name) LIKE LOWER('%company 1%') ORDER BY total_order_amount DESC LIMIT 1;",
+    "SELECT customer_state, SUM(total_order_amount) AS total_order_amount FROM customer_data "
+    "GROUP BY customer_state ORDER BY total_order_amount DESC;",
+    "SELECT customer_name, total_order_amount, order_frequency FROM customer_data "
+    "ORDER BY total_order_amount DESC;",
+    "SELECT year, quarter, COUNT(DISTINCT customer_name) AS customer_count FROM customer_data "
+    "GROUP BY year, quarter ORDER BY year, quarter;",
+]
+
+ANALYSIS = (
+    "Sales are concentrated in a small group of customers. The top accounts make up most of "
+    "the order amount, while order frequency is spread more evenly across the rest."
+)
+
+
+class StubResponse:
+    def __init__(self, content):
+        self.content = content
+
+
+class StubChat:
+    def __init__(self, latency=0.5, token_delay=0.0, sql=None, analysis=ANALYSIS):
+        self.latency = latency
+        self.token_delay = token_delay
+        self.sql = sql or CANNED_SQL
+        self.analysis = analysis
+
+    def respond(self, messages):
+        prompt = messages[-1].content
+        if "schema" in prompt:
+            index = int(hashlib.md5(prompt.encode("utf-8")).hexdigest(), 16) % len(self.sql)
+            return f"Here is the query:\n{self.sql[index]}"
+        return self.analysis
+
+    def invoke(self, messages):
+        time.sleep(self.latency)
+        return StubResponse(self.respond(messages))
+
+    def stream(self, messages):
+        time.sleep(self.latency)
+        for word in self.respond(messages).split(" "):
+            if self.token_delay:
+                time.sleep(self.token_delay)
+            yield StubResponse(word + " ")
+
+    async def ainvoke(self, messages):
+        await asyncio.sleep(self.latency)
+        return StubResponse(self.respond(messages))
+
+    async def astream(self, messages):
+        await asyncio.sleep(self.latency)
+        for word in self.respond(messages).split(" "):
+            if self.token_delay:
+                await asyncio.sleep(self.token_delay)
+            yield StubResponse(word + " ")
@@ -0,0 +1,370 @@
+"""
+The chat pipeline behind /chat, /chat/stream and /chat/batch, on asyncio.
+
+answer_chat() takes one question through the stages (follow-up context or
+schema, result cache, name resolution, SQL generation, query, local format or
+analysis) and yields an event as each stage finishes:
+
+    ("status", {"stage": "generating_sql"})
+    ("sql", {"sql": "SELECT ..."})
+    ("rows", {"result": {...}})            see query_results.py
+    ("token", {"text": "..."})             the analysis, chunk by chunk with stream=True
+    ("done", {"response": ..., "query_info": ...})
+
+/chat returns the "done" data as JSON, /chat/stream sends every event as
+Server-Sent Events and answer_batch() collects the SQL and the answer of each
+question. Claude is called with ainvoke/astream and Postgres is queried through
+pooled asyncpg engines (or DuckDB on a thread with QUERY_BACKEND=duckdb), so a
+request waiting on the LLM or the database doesn't hold a worker thread.
+"""
+import asyncio
+from datetime import datetime
+import os
+
+from langchain_core.messages import HumanMessage
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app import (
+    ChatMessage,
+    DataVersion,
+    analyze_locally,
+    app as flask_app,
+    build_analysis_context,
+    build_followup_context,
+    build_sql_context,
+    cache_usable,
+    duckdb_backend,
+    extract_sql,
+    format_query_info,
+    get_chat,
+    load_schema,
+    logger,
+    message_journal,
+    resolve_customer_names,
+    result_cache,
+    session_memory,
+)
+from async_logging import log_payload
+from batch import run_batch
+from metrics import RequestTimings, observe_cache, observe_llm, observe_query
+from query_governor import run_governed_async
+from session_memory import Turn, last_exchange
+
+
+def async_database_url(database_url):
+    # Use the asyncpg driver (aiosqlite for a local SQLite file) for the same database the Flask app talks to
+    if database_url.startswith("sqlite://"):
+        return database_url.replace("sqlite://", "sqlite+aiosqlite://", 1)
+    return database_url.replace("postgresql://", "postgresql+asyncpg://", 1)
+
+
+async_engine = create_async_engine(
+    async_database_url(flask_app.config["SQLALCHEMY_DATABASE_URI"]),
+    pool_size=int(os.getenv("ASYNC_DB_POOL_SIZE", "20")),
+    max_overflow=int(os.getenv("ASYNC_DB_MAX_OVERFLOW", "20")),
+    pool_pre_ping=True,
+)
+
+# Read-only pool for the generated queries, see app.create_query_engine
+async_query_engine = create_async_engine(
+    async_database_url(flask_app.config["QUERY_DATABASE_URL"]),
+    pool_size=flask_app.config["QUERY_POOL_SIZE"],
+    max_overflow=flask_app.config["QUERY_POOL_MAX_OVERFLOW"],
+    pool_timeout=flask_app.config["QUERY_POOL_TIMEOUT"],
+    pool_pre_ping=True,
+    connect_args=(
+        {"server_settings": {"default_transaction_read_only": "on"}}
+        if flask_app.config["QUERY_DATABASE_URL"].startswith("postgresql")
+        else {}
+    ),
+)
+
+messages_table = ChatMessage.__table__
+data_version_table = DataVersion.__table__
+
+
+def load_schema_in_context():
+    # Catalog mode queries Postgres through Flask-SQLAlchemy, which needs an app context
+    with flask_app.app_context():
+        return load_schema()
+
+
+async def get_data_version(table_name="customer_data"):
+    # Current load version of the table, 0 if it has never been loaded through load_data.py
+    if duckdb_backend is not None:
+        return duckdb_backend.data_version()
+    async with async_engine.connect() as connection:
+        version = await connection.scalar(
+            select(data_version_table.c.version).where(
+                data_version_table.c.table_name == table_name
+            )
+        )
+    return version or 0
+
+
+async def get_recent_turns(session_id):
+    # Recent turns of the session, oldest first. The turns held in memory are used only while the
+    # database has nothing newer, checked with one max(timestamp) query on the session index. An
+    # empty session (e.g. reset by another worker) is a miss too
+    cached = session_memory.get(session_id)
+    if cached is not None:
+        turns, last_timestamp = cached
+        async with async_engine.connect() as connection:
+            latest = await connection.scalar(
+                select(func.max(messages_table.c.timestamp)).where(
+                    messages_table.c.session_id == session_id
+                )
+            )
+        if latest is not None and last_timestamp is not None and latest <= last_timestamp:
+            observe_cache("session", True)
+            return turns
+    observe_cache("session", False)
+
+    await asyncio.to_thread(message_journal.flush)
+    async with async_engine.connect() as connection:
+        rows = (
+            await connection.execute(
+                select(
+                    messages_table.c.content,
+                    messages_table.c.is_user,
+                    messages_table.c.query_info,
+                    messages_table.c.timestamp,
+                )
+                .where(messages_table.c.session_id == session_id)
+                .order_by(messages_table.c.timestamp.desc(), messages_table.c.id.desc())
+                .limit(session_memory.max_turns)
+            )
+        ).all()
+    if not rows:
+        session_memory.clear(session_id)
+        return []
+    turns = [Turn(row.content, row.is_user, row.query_info) for row in reversed(rows)]
+    session_memory.set(session_id, turns, rows[0].timestamp)
+    return turns
+
+
+async def get_followup_context(user_message, session_id):
+    # Build the follow-up prompt from the last exchange of this session
+    last_user_message, last_ai_message = last_exchange(await get_recent_turns(session_id))
+    context = build_followup_context(user_message, last_user_message, last_ai_message)
+    return context, last_ai_message
+
+
+async def save_messages(session_id, *messages):
+    # messages are dicts of ChatMessage column values, queued on the journal
+    # without blocking the event loop and inserted here if it is disabled or full
+    rows = [
+        {"query_info": None, **message, "session_id": session_id, "timestamp": datetime.utcnow()}
+        for message in messages
+    ]
+    if not (flask_app.config["MESSAGE_JOURNAL_ENABLED"] and message_journal.write(rows, timeout=0)):
+        async with async_engine.begin() as connection:
+            await connection.execute(messages_table.insert(), rows)
+    session_memory.append(
+        session_id,
+        *(Turn(row["content"], row["is_user"], row["query_info"]) for row in rows),
+        timestamp=rows[-1]["timestamp"],
+    )
+
+
+async def run_sql(sql_query):
+    # Run the generated query through the governor with a row cap, see query_results.py for the
+    # result format. DuckDB runs in-process, its queries go to a thread so they don't block the event loop
+    if duckdb_backend is not None:
+        return await asyncio.to_thread(duckdb_backend.run, sql_query)
+    async with async_query_engine.connect() as connection:
+        return await run_governed_async(
+            connection,
+            sql_query,
+            max_rows=flask_app.config["QUERY_MAX_ROWS"],
+            batch_size=flask_app.config["QUERY_FETCH_BATCH_SIZE"],
+            summarize=flask_app.config["QUERY_SUMMARY_ON_TRUNCATE"],
+            max_cost=flask_app.config["QUERY_MAX_COST"],
+            statement_timeout_ms=flask_app.config["QUERY_STATEMENT_TIMEOUT_MS"],
+        )
+
+
+async def complete(prompt, stage, timings, stream):
+    # Claude's answer to prompt, chunk by chunk with stream=True, in one piece otherwise.
+    # With stream=True the span includes the time spent sending the chunks to the client
+    with timings.span(stage):
+        if stream:
+            async for chunk in get_chat().astream([HumanMessage(content=prompt)]):
+                yield chunk.content
+        else:
+            yield (await get_chat().ainvoke([HumanMessage(content=prompt)])).content
+
+
+async def answer_chat(user_message, session_id, local_format, timings, stream=False, run_query=None):
+    """
+    Answer one question, yielding the events listed at the top of this module,
+    "done" last. Query errors end in a "done" event with the error appended to
+    the response, other errors are raised.
+
+    If the message starts with "follow up:", Claude answers it from the last
+    exchange of the session instead. Messages are saved under session_id;
+    with session_id None nothing is saved and there are no follow-ups (batch
+    questions). run_query runs the generated SQL, run_sql by default.
+    """
+    run_query = run_query or run_sql
+
+    async def save(*messages):
+        if session_id is not None:
+            with timings.span("db_write"):
+                await save_messages(session_id, *messages)
+
+    if session_id is not None and user_message.lower().startswith("follow up:"):
+        # Remove the "follow up:" prefix
+        user_message = user_message[len("follow up:") :].strip()
+        with timings.span("followup_context"):
+            context, last_ai_message = await get_followup_context(user_message, session_id)
+        await save({"content": user_message, "is_user": True})
+        yield "status", {"stage": "analysis"}
+
+        ai_response = ""
+        async for text in complete(context, "llm_followup", timings, stream):
+            ai_response += text
+            yield "token", {"text": text}
+        observe_llm("llm_followup", context, ai_response)
+
+        # Answer with the query info of the previous answer
+        query_info = last_ai_message.query_info if last_ai_message else None
+        await save({"content": ai_response, "is_user": False, "query_info": query_info})
+        yield "done", {"response": ai_response, "query_info": query_info}
+        return
+
+    with timings.span("schema"):
+        schema_text, schema_hash = await asyncio.to_thread(load_schema_in_context)
+
+    # Serve repeated questions from the result cache
+    with timings.span("cache_lookup"):
+        data_version = await get_data_version()
+        result_cache.sync_data_version(data_version)
+        cache_key = result_cache.make_key(user_message, schema_hash, data_version)
+        cached = result_cache.get(cache_key)
+    cache_hit = cache_usable(cached, local_format)
+    observe_cache("result", cache_hit)
+    if cache_hit:
+        logger.info(f"Result cache hit for message: {user_message}")
+        query_info = format_query_info(cached["query_result"], cached["sql_query"])
+        await save(
+            {"content": user_message, "is_user": True},
+            {"content": cached["analysis"], "is_user": False, "query_info": query_info},
+        )
+        yield "sql", {"sql": cached["sql_query"]}
+        yield "rows", {"result": cached["query_result"]}
+        yield "token", {"text": cached["analysis"]}
+        yield "done", {"response": cached["analysis"], "query_info": query_info, "cached": True}
+        return
+
+    await save({"content": user_message, "is_user": True})
+    yield "status", {"stage": "generating_sql"}
+
+    # The name index may have to be rebuilt after a reload, off the event loop
+    with timings.span("name_resolution"):
+        resolved_names = await asyncio.to_thread(resolve_customer_names, user_message, data_version)
+    with timings.span("prompt_build"):
+        context = build_sql_context(schema_text, user_message, resolved_names)
+    with timings.span("llm_sql"):
+        response = await get_chat().ainvoke([HumanMessage(content=context)])
+    ai_response = response.content
+    observe_llm("llm_sql", context, ai_response)
+    log_payload(logger, "API Call Log", user_message=user_message, prompt=context, response=ai_response)
+
+    with timings.span("sql_extract"):
+        sql_query = extract_sql(ai_response)
+    if not sql_query:
+        # Claude answered without a query, return its text as is
+        await save({"content": ai_response, "is_user": False})
+        yield "token", {"text": ai_response}
+        yield "done", {"response": ai_response, "query_info": None}
+        return
+
+    yield "sql", {"sql": sql_query}
+    try:
+        with timings.span("query"):
+            query_result = await run_query(sql_query)
+        observe_query(query_result)
+    except Exception as e:
+        logger.error(f"Error executing query: {str(e)}")
+        yield "done", {"response": ai_response + f"\n\nError executing query: {str(e)}", "query_info": None}
+        return
+    logger.info(
+        f"Query executed successfully. Rows: {query_result['row_count']}, truncated: {query_result['truncated']}"
+    )
+    yield "rows", {"result": query_result}
+
+    # Trivial results are answered locally without a second Claude call
+    with timings.span("local_format"):
+        analysis = analyze_locally(query_result, local_format)
+    formatted_locally = analysis is not None
+    if formatted_locally:
+        logger.info(f"Answered {user_message} from the local result formatter")
+        yield "token", {"text": analysis}
+    else:
+        yield "status", {"stage": "analysis"}
+        with timings.span("serialize"):
+            analysis_context = build_analysis_context(user_message, query_result)
+        analysis = ""
+        async for text in complete(analysis_context, "llm_analysis", timings, stream):
+            analysis += text
+            yield "token", {"text": text}
+        observe_llm("llm_analysis", analysis_context, analysis)
+        log_payload(logger, "Follow-up API Call Log", prompt=analysis_context, response=analysis)
+
+    with timings.span("serialize"):
+        query_info = format_query_info(query_result, sql_query)
+    await save({"content": analysis, "is_user": False, "query_info": query_info})
+    result_cache.set(
+        cache_key,
+        {
+            "sql_query": sql_query,
+            "query_result": query_result,
+            "analysis": analysis,
+            "formatted_locally": formatted_locally,
+        },
+    )
+    done = {"response": analysis, "query_info": query_info}
+    if formatted_locally:
+        done["formatted_locally"] = True
+    yield "done", done
+
+
+async def answer_batch_question(question, queries, local_format):
+    # Answer one question of a batch, its SQL runs through the batch's shared queries
+    result = {"sql": None}
+    async for event, data in answer_chat(question, None, local_format, RequestTimings(), run_query=queries.get):
+        if event == "sql":
+            result["sql"] = data["sql"]
+        elif event == "done":
+            result.update(data)
+    return result
+
+
+def answer_batch(questions, max_workers=None, local_format=None):
+    """
+    Answer questions concurrently and return an async generator of result
+    dicts in completion order, see batch.py. Batch questions are not saved to
+    the chat history.
+    """
+    if local_format is None:
+        local_format = flask_app.config["LOCAL_FORMAT_ENABLED"]
+
+    async def answer(question, queries):
+        return await answer_batch_question(question, queries, local_format)
+
+    return run_batch(
+        questions,
+        answer,
+        run_sql,
+        max_workers=max_workers or flask_app.config["BATCH_MAX_WORKERS"],
+        max_query_workers=flask_app.config["QUERY_POOL_SIZE"],
+    )
+
+
+async def close():
+    # Write the queued messages and close the pools before the process exits
+    await asyncio.to_thread(message_journal.close)
+    await async_engine.dispose()
+    await async_query_engine.dispose()
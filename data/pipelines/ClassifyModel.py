@@ -1,83 +1,286 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import json
+import os
+
 import duckdb
-from sklearn.cluster import KMeans
-from sklearn.preprocessing import StandardScaler, MinMaxScaler
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.preprocessing import MinMaxScaler
 from sklearn.metrics import silhouette_score
-import matplotlib.pyplot as plt
-from sklearn.decomposition import PCA  
-
-
-#Open duckdb connection
-con = duckdb.connect('my_database.db')
-
-#Select from customers_orders_amt to Pandas Dataframe
-df = con.execute('select * from customers_orders_amt').df()
-
-#Scaling each feature to range [0,1]
-scaler = MinMaxScaler()
-
-#Create scalar 1
-X_scaled_1 = scaler.fit_transform(df[['TOTAL_ORDER_AMOUNT', 'AVERAGE_ORDER_AMOUNT']])
-
-#Predicting
-kmeans_1 = KMeans(n_clusters=3, init='k-means++', random_state=42)
-df['Categorized_1'] = kmeans_1.fit_predict(X_scaled_1)
-
-#Mapping the categories it produced for scalar 1.
-cluster_mapping_1 = {0: 'Low-End Sales Customer', 1: 'Medium Sales Customer', 2: 'High-Valued Sales Customer'}
-df['Categorized_1_Label'] = df['Categorized_1'].map(cluster_mapping_1)
-
-#Create scalar 2
-X_scaled_2 = scaler.fit_transform(df[['TOTAL_QTY_EACH', 'AVERAGE_QTY_EACH']])
-
-#Predicting
-kmeans_2 = KMeans(n_clusters=3, init='k-means++', random_state=42)
-df['Categorized2'] = kmeans_2.fit_predict(X_scaled_2)
-
-#Mapping the categories it produced for scalar 2.
-cluster_mapping_2 = {0: 'Low-End QTY Customer', 1: 'Medium QTY Customer', 2: 'High QTY Customer'}
-df['Categorized_2_Label'] = df['Categorized2'].map(cluster_mapping_2)
-
-
-# Visualize the First Categorization
-plt.figure(figsize=(10, 5))
-for category in range(kmeans_1.n_clusters):  # Iterate over the clusters
-    cluster_points = X_scaled_1[df['Categorized_1'] == category]
-    plt.scatter(
-        cluster_points[:, 0],
-        cluster_points[:, 1],
-        label=f'Categorized_1 {category}'
-    )
-
-centroids_1 = kmeans_1.cluster_centers_
-plt.scatter(centroids_1[:, 0], centroids_1[:, 1], s=300, c='red', marker='X', label='Centroids_1')
-plt.xlabel('Total Order Amount (Scaled)')
-plt.ylabel('Average Order Amount (Scaled)')
-plt.title('Customer Clusters for Categorization 1')
-plt.legend()
-plt.show()
-
-# Visualize the Second Categorization
-plt.figure(figsize=(10, 5))
-for category in range(kmeans_2.n_clusters):  # Iterate over the clusters
-    cluster_points = X_scaled_2[df['Categorized2'] == category]
-    plt.scatter(
-        cluster_points[:, 0],
-        cluster_points[:, 1],
-        label=f'Categorized2 {category}'
-    )
-
-centroids_2 = kmeans_2.cluster_centers_
-plt.scatter(centroids_2[:, 0], centroids_2[:, 1], s=300, c='blue', marker='X', label='Centroids_2')
-plt.xlabel('TOTAL_QTY_EACH (Scaled)')
-plt.ylabel('AVERAGE_QTY_EACH (Scaled)')
-plt.title('Customer Clusters for Categorization 2')
-plt.legend()
-plt.show()
-
-#Drop the Numeric categorized columns.
-df.drop(columns=['Categorized2','Categorized_1' ], inplace=True)
-
-#export to csv
-df.to_csv('clustered_customers.csv', index=False)
-
-con.close()
\ No newline at end of file
+
+
+#The two categorizations, each fitted on its own pair of features.
+#Labels are listed from the smallest to the largest centroid.
+FEATURE_SETS = {
+    'Categorized_1': {
+        'columns': ['TOTAL_ORDER_AMOUNT', 'AVERAGE_ORDER_AMOUNT'],
+        'labels': ['Low-End Sales Customer', 'Medium Sales Customer', 'High-Valued Sales Customer'],
+        'fallback_label': 'Sales Cluster',
+        'plot_labels': ('Total Order Amount (Scaled)', 'Average Order Amount (Scaled)'),
+        'centroid_color': 'red',
+    },
+    'Categorized_2': {
+        'columns': ['TOTAL_QTY_EACH', 'AVERAGE_QTY_EACH'],
+        'labels': ['Low-End QTY Customer', 'Medium QTY Customer', 'High QTY Customer'],
+        'fallback_label': 'QTY Cluster',
+        'plot_labels': ('TOTAL_QTY_EACH (Scaled)', 'AVERAGE_QTY_EACH (Scaled)'),
+        'centroid_color': 'blue',
+    },
+}
+
+SOURCE_TABLE = 'customers_orders_amt'
+OUTPUT_TABLE = 'clustered_customers'
+
+
+def feature_query(columns, sample_rows=None):
+    select = ', '.join(f'COALESCE({c}, 0)::DOUBLE AS {c}' for c in columns)
+    sample = f' USING SAMPLE {sample_rows} ROWS' if sample_rows else ''
+    return f'SELECT {select} FROM {SOURCE_TABLE}{sample}'
+
+
+def read_feature_chunks(cursor, columns, chunk_size):
+    #Streams the feature columns out of DuckDB as numpy matrices of at most chunk_size rows.
+    reader = cursor.execute(feature_query(columns)).fetch_record_batch(chunk_size)
+    for batch in reader:
+        if batch.num_rows:
+            yield np.column_stack([batch.column(c).to_numpy() for c in columns])
+
+
+def read_sample(cursor, columns, sample_rows):
+    table = cursor.execute(feature_query(columns, sample_rows)).fetch_arrow_table()
+    return np.column_stack([table.column(c).to_numpy() for c in columns])
+
+
+def select_k(scaled_sample, k_values):
+    #Pick the number of clusters with the best silhouette score on a sample.
+    scores = {}
+    for k in k_values:
+        labels = KMeans(n_clusters=k, init='k-means++', n_init=3, random_state=42).fit_predict(scaled_sample)
+        scores[k] = silhouette_score(scaled_sample, labels, sample_size=min(len(scaled_sample), 5000), random_state=42)
+    best = max(scores, key=scores.get)
+    print(f"Silhouette scores: {scores}, using k={best}")
+    return best
+
+
+def fit_feature_set(con, name, args):
+    #Fits the scaler and a MiniBatchKMeans for one feature set over streamed chunks.
+    columns = FEATURE_SETS[name]['columns']
+    cursor = con.cursor()
+
+    #Scaling each feature to range [0,1], min/max are accumulated chunk by chunk.
+    scaler = MinMaxScaler()
+    for X in read_feature_chunks(cursor, columns, args.chunk_size):
+        scaler.partial_fit(X)
+
+    n_clusters = args.clusters
+    if args.select_k:
+        sample = scaler.transform(read_sample(cursor, columns, args.sample_rows))
+        n_clusters = select_k(sample, range(args.min_k, args.max_k + 1))
+
+    kmeans = MiniBatchKMeans(n_clusters=n_clusters, init='k-means++', random_state=42, n_init=3)
+    for _ in range(args.passes):
+        for X in read_feature_chunks(cursor, columns, args.chunk_size):
+            #partial_fit needs at least n_clusters samples in its first batch
+            if len(X) >= n_clusters:
+                kmeans.partial_fit(scaler.transform(X))
+
+    cursor.close()
+    print(f"Fitted {name} with {n_clusters} clusters")
+    return scaler, kmeans
+
+
+def cluster_label_names(name, n_clusters):
+    settings = FEATURE_SETS[name]
+    if n_clusters == len(settings['labels']):
+        return list(settings['labels'])
+    return [f"{settings['fallback_label']} {c}" for c in range(n_clusters)]
+
+
+def build_model(name, scaler, kmeans):
+    #Serializable model for one feature set. Centroids are sorted by magnitude so the
+    #same customers get the same label on every refit, whatever ids KMeans assigned.
+    centroids = kmeans.cluster_centers_
+    order = np.argsort(np.linalg.norm(centroids, axis=1))
+    return {
+        'columns': FEATURE_SETS[name]['columns'],
+        'data_min': scaler.data_min_.tolist(),
+        'data_max': scaler.data_max_.tolist(),
+        'centroids': centroids[order].tolist(),
+        'labels': cluster_label_names(name, kmeans.n_clusters),
+    }
+
+
+def save_model_artifact(models, model_dir):
+    #Writes cluster_model_<version>.json and points LATEST at it.
+    os.makedirs(model_dir, exist_ok=True)
+    version = datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')
+    artifact = {
+        'version': version,
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'feature_sets': {name: build_model(name, scaler, kmeans) for name, (scaler, kmeans) in models.items()},
+    }
+    with open(os.path.join(model_dir, f'cluster_model_{version}.json'), 'w') as f:
+        json.dump(artifact, f, indent=2)
+    with open(os.path.join(model_dir, 'LATEST'), 'w') as f:
+        f.write(version)
+    print(f"Saved cluster model version {version} to {model_dir}")
+    return artifact
+
+
+def load_model_artifact(model_dir, version=None):
+    if version is None:
+        with open(os.path.join(model_dir, 'LATEST')) as f:
+            version = f.read().strip()
+    with open(os.path.join(model_dir, f'cluster_model_{version}.json')) as f:
+        return json.load(f)
+
+
+def score(model, X):
+    #Vectorized nearest-centroid labels for the rows of X.
+    data_min = np.asarray(model['data_min'])
+    data_range = np.asarray(model['data_max']) - data_min
+    data_range[data_range == 0] = 1
+    X_scaled = (X - data_min) / data_range
+    centroids = np.asarray(model['centroids'])
+    distances = ((X_scaled[:, None, :] - centroids[None, :, :]) ** 2).sum(axis=2)
+    return np.asarray(model['labels'])[distances.argmin(axis=1)]
+
+
+def label_batch(artifact, batch):
+    #Appends a <feature set>_Label column per feature set to an Arrow record batch.
+    for name, model in artifact['feature_sets'].items():
+        X = np.column_stack([
+            pc.fill_null(batch.column(c), 0).to_numpy(zero_copy_only=False) for c in model['columns']
+        ]).astype(float)
+        batch = batch.append_column(f'{name}_Label', pa.array(score(model, X)))
+    return batch
+
+
+def write_labels(con, artifact, output_path, chunk_size):
+    #Streams the source table, labels each batch and writes Parquet.
+    reader = con.execute(f'SELECT * FROM {SOURCE_TABLE}').fetch_record_batch(chunk_size)
+    writer = None
+    total_rows = 0
+    for batch in reader:
+        batch = label_batch(artifact, batch)
+        if writer is None:
+            writer = pq.ParquetWriter(output_path, batch.schema)
+        writer.write_batch(batch)
+        total_rows += batch.num_rows
+    if writer is not None:
+        writer.close()
+    return total_rows
+
+
+def pending_groups_filter(alias):
+    return f"""EXISTS (
+        SELECT 1 FROM PENDING_SCORING p
+        WHERE p.CUSTOMER_COMPANY_NAME = {alias}.CUSTOMER_NAME AND p.YEAR = {alias}.YEAR AND p.QUARTER = {alias}.QUARTER
+    )"""
+
+
+def score_pending(con, artifact, output_path, chunk_size):
+    #Relabels only the groups IngestCustomerFiles.py queued in PENDING_SCORING, no refit.
+    con.execute("CREATE TABLE IF NOT EXISTS PENDING_SCORING (CUSTOMER_COMPANY_NAME VARCHAR, YEAR INTEGER, QUARTER INTEGER)")
+    con.execute(f"DELETE FROM {OUTPUT_TABLE} c WHERE {pending_groups_filter('c')}")
+
+    #Read on a separate cursor, the inserts below would otherwise invalidate the reader
+    reader = con.cursor().execute(
+        f"SELECT * FROM {SOURCE_TABLE} a WHERE {pending_groups_filter('a')}"
+    ).fetch_record_batch(chunk_size)
+    total_rows = 0
+    for batch in reader:
+        con.register('scored_batch', label_batch(artifact, batch))
+        con.execute(f"INSERT INTO {OUTPUT_TABLE} BY NAME SELECT * FROM scored_batch")
+        con.unregister('scored_batch')
+        total_rows += batch.num_rows
+
+    con.execute("DELETE FROM PENDING_SCORING")
+    con.execute(f"COPY {OUTPUT_TABLE} TO '{output_path}' (FORMAT parquet)")
+    return total_rows
+
+
+def plot_clusters(con, models, sample_rows, plot_dir):
+    #Scatter plots of a sample of each categorization, shown or saved to plot_dir.
+    import matplotlib
+    if plot_dir:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    for name, (scaler, kmeans) in models.items():
+        settings = FEATURE_SETS[name]
+        X_scaled = scaler.transform(read_sample(con.cursor(), settings['columns'], sample_rows))
+        clusters = kmeans.predict(X_scaled)
+
+        plt.figure(figsize=(10, 5))
+        for category in range(kmeans.n_clusters):  # Iterate over the clusters
+            cluster_points = X_scaled[clusters == category]
+            plt.scatter(cluster_points[:, 0], cluster_points[:, 1], label=f'{name} {category}')
+
+        centroids = kmeans.cluster_centers_
+        plt.scatter(centroids[:, 0], centroids[:, 1], s=300, c=settings['centroid_color'], marker='X', label=f'Centroids {name}')
+        plt.xlabel(settings['plot_labels'][0])
+        plt.ylabel(settings['plot_labels'][1])
+        plt.title(f'Customer Clusters for {name}')
+        plt.legend()
+        if plot_dir:
+            plt.savefig(f'{plot_dir}/{name}.png')
+            plt.close()
+        else:
+            plt.show()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Cluster customers_orders_amt into sales and quantity categories")
+    parser.add_argument('--database', default='my_database.db')
+    parser.add_argument('--output', default='clustered_customers.parquet')
+    parser.add_argument('--clusters', type=int, default=3, help="Number of clusters when --select-k is not set")
+    parser.add_argument('--select-k', action='store_true', help="Choose the number of clusters by silhouette score")
+    parser.add_argument('--min-k', type=int, default=2)
+    parser.add_argument('--max-k', type=int, default=8)
+    parser.add_argument('--sample-rows', type=int, default=20000, help="Rows sampled for --select-k and plots")
+    parser.add_argument('--chunk-size', type=int, default=100000, help="Rows read from DuckDB per batch")
+    parser.add_argument('--passes', type=int, default=3, help="Passes over the data when fitting")
+    parser.add_argument('--jobs', type=int, default=2, help="Feature sets fitted in parallel")
+    parser.add_argument('--plot', action='store_true', help="Show the cluster plots")
+    parser.add_argument('--plot-dir', help="Save the cluster plots to this directory instead of showing them")
+    parser.add_argument('--model-dir', default='cluster_models', help="Where versioned cluster model artifacts are kept")
+    parser.add_argument('--score', action='store_true',
+                        help="Label only new or changed rows with the saved model instead of refitting")
+    parser.add_argument('--model-version', help="Model version used by --score, defaults to the latest")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    #Open duckdb connection
+    con = duckdb.connect(args.database)
+
+    if args.score:
+        artifact = load_model_artifact(args.model_dir, args.model_version)
+        total_rows = score_pending(con, artifact, args.output, args.chunk_size)
+        print(f"Scored {total_rows} new or changed rows with cluster model version {artifact['version']}")
+    else:
+        #Fit both categorizations in parallel, each on its own DuckDB cursor.
+        with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+            futures = {name: pool.submit(fit_feature_set, con, name, args) for name in FEATURE_SETS}
+            models = {name: future.result() for name, future in futures.items()}
+
+        if args.plot or args.plot_dir:
+            plot_clusters(con, models, args.sample_rows, args.plot_dir)
+
+        artifact = save_model_artifact(models, args.model_dir)
+        total_rows = write_labels(con, artifact, args.output, args.chunk_size)
+
+        #Keep the result in DuckDB as well, every row is labelled so nothing is pending.
+        con.execute(f"CREATE OR REPLACE TABLE {OUTPUT_TABLE} AS SELECT * FROM read_parquet('{args.output}')")
+        con.execute("DROP TABLE IF EXISTS PENDING_SCORING")
+        print(f"Wrote {total_rows} clustered rows to {args.output}")
+
+    con.close()
\ No newline at end of file
@@ -1,85 +1,28 @@
 import duckdb
-from duckdb.experimental.spark.sql import SparkSession as session
-from duckdb.experimental.spark.sql.functions import lit, col
+import argparse
+import hashlib
 import os
 
 #Open duckdb connection
 con = duckdb.connect('my_database.db')
 
-#Initialize DuckDB-backed Spark session
-spark = session.builder.config('duckdb.database', 'my_database.db').getOrCreate()
+#File/Folder paths of dataset, DUCKDB_DATA_DIR points them at another folder (e.g. bench/ synthetic data).
+datadirectory = os.getenv('DUCKDB_DATA_DIR', 'C:/Users/hlu/Documents/duckdb')
+salesdirectory = f'{datadirectory}/Sales'
+customerdirectory = f'{datadirectory}/Customers/CUSTOMER_DIM.csv'
+productdirectory = f'{datadirectory}/Products/product_category.csv'
 
-#File/Folder paths of dataset.
-salesdirectory = f'C:/Users/hlu/Documents/duckdb/Sales'
-customerdirectory = f'C:/Users/hlu/Documents/duckdb/Customers/CUSTOMER_DIM.csv'
-productdirectory = f'C:/Users/hlu/Documents/duckdb/Products/product_category.csv'
-
-#Sales Folder has multiple csv files, it stores all the files into an array.
-csv_files = [f for f in os.listdir(salesdirectory) if f.endswith('.csv')]
-
-#this joins all the csv files into a temp table.
-union_query = "\nUNION ALL\n".join(
-    [f"SELECT * FROM read_csv('{os.path.join(salesdirectory, file)}', delim='`')" for file in csv_files]
-)
-
-
-flat_query = f"""
-    SELECT 	NET_SALES_USD_BUDGET,
-    NET_QTY_EACH,
-     ACTIVITY_DATE,
-      TRIM(SUBSTR(CUSTOMER_NAME, INSTR(CUSTOMER_NAME, ' - ') + 3)) AS CUSTOMER_COMPANY_NAME,
-      BACKEND_NAME CUSTOMER_PERSON_NAME,
-      ADDRESS CUSTOMER_ADDRESS,
-      CITY CUSTOMER_CITY,
-      COUNTRY CUSTOMER_COUNTRY,
-      STATE_PROV CUSTOMER_STATE,
-      MEMBER_INFO_TYPE CUSTOMER_MEMBER_TYPE,
-      ITEM AS ITEM_NUMBER,
-      ITEM_DESCRIPTION,
-      PRODUCT_TYPE,
-      BACKEND_MARKET_SEGMENT_SE PRODUCT_CATEGORY,
-      1999 AS YEAR,
-      '' AS QUARTER
-    FROM (
-        {union_query}
-    ) AS unioned_files
-    JOIN read_csv('{customerdirectory}', delim=',',ignore_errors=true) AS customer_dim
-    ON unioned_files.DIR_CUSTOMER_COMPANY_KEY = customer_dim.CUSTOMER_COMPANY_KEY
-        JOIN read_csv_auto('{productdirectory}',delim=',',ignore_errors=true)  AS product_dim
-    ON unioned_files.ITEM_COMPANY_KEY = product_dim.ITEM_COMPANY_KEY
-    WHERE 
-        CUSTOMER_NAME NOT LIKE '%??%' 
-        AND STATE_PROV NOT LIKE '%?%' 
-        AND CITY NOT LIKE '%?%'
-"""
-
-#Create a table in Spark SQL to store the flattened query results
-spark.sql(f"CREATE TABLE CUSTOMER_ORDERS as {flat_query}")
-
-
-spark.sql(f"""
-    UPDATE CUSTOMER_ORDERS
-    SET ACTIVITY_DATE = STRFTIME(CAST(ACTIVITY_DATE AS DATE), '%m/%d/%Y')
-    WHERE ACTIVITY_DATE LIKE '%-%'
-""")
-
-#Update activity dates and extract year and quarter
-spark.sql(f"""
-    UPDATE CUSTOMER_ORDERS
-    SET YEAR = EXTRACT(YEAR FROM STRPTIME(ACTIVITY_DATE, '%m/%d/%Y')),  QUARTER =  EXTRACT(QUARTER FROM STRPTIME(ACTIVITY_DATE, '%m/%d/%Y'))
-""")
-
-# Aggregate data for customer order summaries
-new_results_df = spark.sql(f"""
-        SELECT 
-        SUM(NET_SALES_USD_BUDGET) TOTAL_ORDER_AMOUNT,  
+#Aggregation of CUSTOMER_ORDERS into customer order summaries, {where} limits the groups recomputed.
+aggregate_query = """
+        SELECT
+        SUM(NET_SALES_USD_BUDGET) TOTAL_ORDER_AMOUNT,
         AVG(NET_SALES_USD_BUDGET) AVERAGE_ORDER_AMOUNT,
         SUM(NET_QTY_EACH) TOTAL_QTY_EACH,
         AVG(NET_QTY_EACH) AVERAGE_QTY_EACH,
         CUSTOMER_COMPANY_NAME CUSTOMER_NAME,
         CUSTOMER_CITY,
         CUSTOMER_STATE,
-        CUSTOMER_COUNTRY
+        CUSTOMER_COUNTRY,
         CUSTOMER_MEMBER_TYPE,
         COUNT(*) AS ORDER_FREQUENCY,
          YEAR,
@@ -88,16 +31,17 @@ new_results_df = spark.sql(f"""
        SUM(CASE WHEN PRODUCT_CATEGORY = 'Infusion_Systems' THEN 1 ELSE 0 END) AS INFUSION_SYSTEMS_COUNT,
        SUM(CASE WHEN PRODUCT_CATEGORY = 'Vascular Access' THEN 1 ELSE 0 END) AS VASCULAR_ACCESS_COUNT,
        SUM(CASE WHEN PRODUCT_CATEGORY = 'Oncology' THEN 1 ELSE 0 END) AS ONCOLOGY_COUNT,
-         SUM(CASE WHEN PRODUCT_CATEGORY = 'Other' THEN 1 ELSE 0 END) AS OTHER_COUNT,                    
-          SUM(CASE WHEN PRODUCT_CATEGORY = 'Veterinary' THEN 1 ELSE 0 END) AS VETERINARY_COUNT,      
+         SUM(CASE WHEN PRODUCT_CATEGORY = 'Other' THEN 1 ELSE 0 END) AS OTHER_COUNT,
+          SUM(CASE WHEN PRODUCT_CATEGORY = 'Veterinary' THEN 1 ELSE 0 END) AS VETERINARY_COUNT,
       SUM(CASE WHEN PRODUCT_CATEGORY = 'Service' THEN 1 ELSE 0 END) AS SERVICE_COUNT,
-       SUM(CASE WHEN PRODUCT_CATEGORY = 'Critical Care' THEN 1 ELSE 0 END) AS CRITICAL_CARE_COUNT,                    
-          SUM(CASE WHEN PRODUCT_CATEGORY = 'Respiratory' THEN 1 ELSE 0 END) AS RESPIRATORY_COUNT, 
-      SUM(CASE WHEN PRODUCT_CATEGORY = 'Solutions' THEN 1 ELSE 0 END) AS SOLUTIONS_COUNT,     
+       SUM(CASE WHEN PRODUCT_CATEGORY = 'Critical Care' THEN 1 ELSE 0 END) AS CRITICAL_CARE_COUNT,
+          SUM(CASE WHEN PRODUCT_CATEGORY = 'Respiratory' THEN 1 ELSE 0 END) AS RESPIRATORY_COUNT,
+      SUM(CASE WHEN PRODUCT_CATEGORY = 'Solutions' THEN 1 ELSE 0 END) AS SOLUTIONS_COUNT,
       SUM(CASE WHEN PRODUCT_CATEGORY = 'N/A' THEN 1 ELSE 0 END) AS NA_COUNT,
-                                                                    
+
     FROM CUSTOMER_ORDERS
-    GROUP BY 
+    {where}
+    GROUP BY
         CUSTOMER_COMPANY_NAME,
         YEAR,
         QUARTER,
@@ -105,18 +49,302 @@ new_results_df = spark.sql(f"""
         CUSTOMER_STATE,
         CUSTOMER_MEMBER_TYPE,
         CUSTOMER_COUNTRY
-""")
+"""
+
+
+def file_hash(path):
+    #sha256 of the file contents, read in 1MB blocks.
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def table_exists(name):
+    return con.execute(
+        "SELECT COUNT(*) FROM information_schema.tables WHERE lower(table_name) = lower(?)", [name]
+    ).fetchone()[0] > 0
+
+
+def scan_sales_files():
+    #Returns {file name: (size, mtime)} for every csv in the sales folder.
+    files = {}
+    for f in os.listdir(salesdirectory):
+        if f.endswith('.csv'):
+            stat = os.stat(os.path.join(salesdirectory, f))
+            files[f] = (stat.st_size, int(stat.st_mtime))
+    return files
+
+
+def changed_sales_files(files):
+    #Compare the sales folder with the manifest, returns the new, the changed and the removed files.
+    manifest = {
+        row[0]: row[1:]
+        for row in con.execute("SELECT FILE_NAME, FILE_SIZE, FILE_MTIME, FILE_HASH FROM INGESTED_FILES").fetchall()
+    }
+    new_files, changed_files = [], []
+    for f, (size, mtime) in files.items():
+        if f not in manifest:
+            new_files.append(f)
+            continue
+        old_size, old_mtime, old_hash = manifest[f]
+        if (size, mtime) == (old_size, old_mtime):
+            continue
+        #Only hash files whose size or mtime moved, a touched but identical file is not re-ingested.
+        if file_hash(os.path.join(salesdirectory, f)) != old_hash:
+            changed_files.append(f)
+        else:
+            con.execute("UPDATE INGESTED_FILES SET FILE_SIZE = ?, FILE_MTIME = ? WHERE FILE_NAME = ?", [size, mtime, f])
+    removed_files = [f for f in manifest if f not in files]
+    return new_files, changed_files, removed_files
+
+
+def record_ingested_files(file_names, files):
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS INGESTED_FILES (
+            FILE_NAME VARCHAR PRIMARY KEY,
+            FILE_SIZE BIGINT,
+            FILE_MTIME BIGINT,
+            FILE_HASH VARCHAR,
+            INGESTED_AT TIMESTAMP
+        )
+    """)
+    for f in file_names:
+        size, mtime = files[f]
+        con.execute(
+            "INSERT OR REPLACE INTO INGESTED_FILES VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)",
+            [f, size, mtime, file_hash(os.path.join(salesdirectory, f))]
+        )
+
+
+#Explicit types for every column read from the source files, so no file's sniffed types decide them.
+#The join keys are text on both sides, a key that looks numeric in one file and not in another still joins.
+sales_column_types = {
+    'NET_SALES_USD_BUDGET': 'DOUBLE',
+    'NET_QTY_EACH': 'DOUBLE',
+    'ACTIVITY_DATE': 'VARCHAR',
+    'DIR_CUSTOMER_COMPANY_KEY': 'VARCHAR',
+    'ITEM_COMPANY_KEY': 'VARCHAR',
+}
+customer_column_types = {
+    'CUSTOMER_COMPANY_KEY': 'VARCHAR',
+    'CUSTOMER_NAME': 'VARCHAR',
+    'BACKEND_NAME': 'VARCHAR',
+    'ADDRESS': 'VARCHAR',
+    'CITY': 'VARCHAR',
+    'COUNTRY': 'VARCHAR',
+    'STATE_PROV': 'VARCHAR',
+    'MEMBER_INFO_TYPE': 'VARCHAR',
+}
+product_column_types = {
+    'ITEM_COMPANY_KEY': 'VARCHAR',
+    'ITEM': 'VARCHAR',
+    'ITEM_DESCRIPTION': 'VARCHAR',
+    'PRODUCT_TYPE': 'VARCHAR',
+    'BACKEND_MARKET_SEGMENT_SE': 'VARCHAR',
+}
+
+
+def csv_types(column_types):
+    #read_csv types={...} argument for a column type map.
+    return "{" + ", ".join(f"'{name}': '{data_type}'" for name, data_type in column_types.items()) + "}"
+
+
+def sales_source(file_names=None):
+    #One parallel read_csv over a glob of the whole sales folder, or over a list of files.
+    if file_names is None:
+        files = f"'{salesdirectory}/*.csv'"
+    else:
+        files = "[" + ", ".join(f"'{os.path.join(salesdirectory, file)}'" for file in file_names) + "]"
+    return (
+        f"read_csv({files}, delim='`', types={csv_types(sales_column_types)}, "
+        "union_by_name=true, filename=true, parallel=true)"
+    )
+
+
+def dimension_source(path, column_types):
+    #Every column is typed, so ignore_errors only skips lines with the wrong number of fields.
+    return f"read_csv('{path}', delim=',', types={csv_types(column_types)}, ignore_errors=true)"
+
+
+#Bumped whenever company_name_sql changes. Names derived the old way would be split from the new ones
+#across customer groups, so an incremental run on tables built with another version does a full rebuild.
+NAME_DERIVATION_VERSION = 2
+
+
+def stored_name_derivation_version():
+    #Name derivation the current tables were built with, 1 for tables built before it was recorded.
+    if not table_exists('INGEST_SETTINGS'):
+        return 1
+    row = con.execute("SELECT NAME_DERIVATION_VERSION FROM INGEST_SETTINGS").fetchone()
+    return row[0] if row else 1
+
+
+def record_name_derivation_version():
+    con.execute("CREATE OR REPLACE TABLE INGEST_SETTINGS (NAME_DERIVATION_VERSION INTEGER)")
+    con.execute("INSERT INTO INGEST_SETTINGS VALUES (?)", [NAME_DERIVATION_VERSION])
+
+
+def company_name_sql(column):
+    #Company part of "<code> - <company>" with runs of whitespace collapsed, the whole name when there
+    #is no code. These are the exact names the app matches questions against, see name_index.py.
+    return f"""TRIM(REGEXP_REPLACE(
+        CASE WHEN INSTR({column}, ' - ') > 0 THEN SUBSTR({column}, INSTR({column}, ' - ') + 3) ELSE {column} END,
+        '\\s+', ' ', 'g'
+      ))"""
+
+
+def flatten_files(file_names, target_table):
+    #Join the sales files (all of them when file_names is None) with the customer and product
+    #dimensions into target_table in a single scan. ACTIVITY_DATE arrives as either
+    #YYYY-MM-DD or MM/DD/YYYY text and is normalized to a DATE, YEAR and QUARTER are computed inline.
+    flat_query = f"""
+    WITH sales AS (
+        SELECT *,
+            COALESCE(
+                TRY_STRPTIME(ACTIVITY_DATE, '%m/%d/%Y'),
+                TRY_CAST(ACTIVITY_DATE AS TIMESTAMP)
+            )::DATE AS ORDER_DATE,
+            parse_filename(filename) AS SOURCE_FILE
+        FROM {sales_source(file_names)}
+    )
+    SELECT 	NET_SALES_USD_BUDGET,
+    NET_QTY_EACH,
+     ORDER_DATE AS ACTIVITY_DATE,
+      {company_name_sql('CUSTOMER_NAME')} AS CUSTOMER_COMPANY_NAME,
+      BACKEND_NAME CUSTOMER_PERSON_NAME,
+      ADDRESS CUSTOMER_ADDRESS,
+      CITY CUSTOMER_CITY,
+      COUNTRY CUSTOMER_COUNTRY,
+      STATE_PROV CUSTOMER_STATE,
+      MEMBER_INFO_TYPE CUSTOMER_MEMBER_TYPE,
+      ITEM AS ITEM_NUMBER,
+      ITEM_DESCRIPTION,
+      PRODUCT_TYPE,
+      BACKEND_MARKET_SEGMENT_SE PRODUCT_CATEGORY,
+      CAST(EXTRACT(YEAR FROM ORDER_DATE) AS INTEGER) AS YEAR,
+      CAST(EXTRACT(QUARTER FROM ORDER_DATE) AS INTEGER) AS QUARTER,
+      SOURCE_FILE
+    FROM sales
+    JOIN {dimension_source(customerdirectory, customer_column_types)} AS customer_dim
+    ON sales.DIR_CUSTOMER_COMPANY_KEY = customer_dim.CUSTOMER_COMPANY_KEY
+    JOIN {dimension_source(productdirectory, product_column_types)} AS product_dim
+    ON sales.ITEM_COMPANY_KEY = product_dim.ITEM_COMPANY_KEY
+    WHERE
+        CUSTOMER_NAME NOT LIKE '%??%'
+        AND STATE_PROV NOT LIKE '%?%'
+        AND CITY NOT LIKE '%?%'
+"""
+
+    #Create a table to store the flattened query results
+    con.execute(f"CREATE OR REPLACE TABLE {target_table} as {flat_query}")
+
+
+def queue_for_scoring(groups_query):
+    #Customer/year/quarter groups whose aggregates changed, ClassifyModel.py --score relabels only these.
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS PENDING_SCORING (
+            CUSTOMER_COMPANY_NAME VARCHAR, YEAR INTEGER, QUARTER INTEGER
+        )
+    """)
+    con.execute(f"INSERT INTO PENDING_SCORING {groups_query}")
+
+
+def full_ingest(files):
+    #Rebuild CUSTOMER_ORDERS and customers_orders_amt from every sales file.
+    flatten_files(None, 'CUSTOMER_ORDERS')
+
+    # Aggregate data for customer order summaries straight into the customers_order_amt table
+    con.execute("CREATE OR REPLACE TABLE customers_orders_amt AS " + aggregate_query.format(where=''))
+
+    con.execute("DROP TABLE IF EXISTS INGESTED_FILES")
+    record_ingested_files(list(files), files)
+
+    record_name_derivation_version()
+
+    con.execute("DROP TABLE IF EXISTS PENDING_SCORING")
+    queue_for_scoring("SELECT DISTINCT CUSTOMER_NAME, YEAR, QUARTER FROM customers_orders_amt")
+    print(f"Full ingest of {len(files)} sales files")
+
+
+def incremental_ingest(files):
+    #Append new and changed sales files, drop the rows of removed ones and recompute only the
+    #affected aggregate groups.
+    new_files, changed_files, removed_files = changed_sales_files(files)
+    if not new_files and not changed_files and not removed_files:
+        print("No new, changed or removed sales files")
+        return
+
+    con.execute("CREATE OR REPLACE TEMP TABLE AFFECTED_GROUPS (CUSTOMER_COMPANY_NAME VARCHAR, YEAR INTEGER, QUARTER INTEGER)")
+
+    #Rows of changed and removed files are deleted, their old groups need recomputing too.
+    old_files = changed_files + removed_files
+    if old_files:
+        placeholders = ', '.join('?' for _ in old_files)
+        con.execute(f"""
+            INSERT INTO AFFECTED_GROUPS
+            SELECT DISTINCT CUSTOMER_COMPANY_NAME, YEAR, QUARTER FROM CUSTOMER_ORDERS
+            WHERE SOURCE_FILE IN ({placeholders})
+        """, old_files)
+        con.execute(f"DELETE FROM CUSTOMER_ORDERS WHERE SOURCE_FILE IN ({placeholders})", old_files)
+
+    if new_files or changed_files:
+        flatten_files(new_files + changed_files, 'NEW_CUSTOMER_ORDERS')
+        con.execute("""
+            INSERT INTO AFFECTED_GROUPS
+            SELECT DISTINCT CUSTOMER_COMPANY_NAME, YEAR, QUARTER FROM NEW_CUSTOMER_ORDERS
+        """)
+        con.execute("INSERT INTO CUSTOMER_ORDERS BY NAME SELECT * FROM NEW_CUSTOMER_ORDERS")
+        con.execute("DROP TABLE NEW_CUSTOMER_ORDERS")
+
+    #Recompute the aggregates of the affected (customer, year, quarter) groups only.
+    con.execute("""
+        DELETE FROM customers_orders_amt USING AFFECTED_GROUPS g
+        WHERE customers_orders_amt.CUSTOMER_NAME = g.CUSTOMER_COMPANY_NAME
+            AND customers_orders_amt.YEAR = g.YEAR
+            AND customers_orders_amt.QUARTER = g.QUARTER
+    """)
+    con.execute("INSERT INTO customers_orders_amt BY NAME " + aggregate_query.format(where="""
+        WHERE EXISTS (
+            SELECT 1 FROM AFFECTED_GROUPS g
+            WHERE g.CUSTOMER_COMPANY_NAME = CUSTOMER_ORDERS.CUSTOMER_COMPANY_NAME
+                AND g.YEAR = CUSTOMER_ORDERS.YEAR
+                AND g.QUARTER = CUSTOMER_ORDERS.QUARTER
+        )
+    """))
 
+    record_ingested_files(new_files + changed_files, files)
+    if removed_files:
+        placeholders = ', '.join('?' for _ in removed_files)
+        con.execute(f"DELETE FROM INGESTED_FILES WHERE FILE_NAME IN ({placeholders})", removed_files)
+    queue_for_scoring("SELECT DISTINCT * FROM AFFECTED_GROUPS")
+    affected = con.execute("SELECT COUNT(*) FROM (SELECT DISTINCT * FROM AFFECTED_GROUPS)").fetchone()[0]
+    print(f"Incremental ingest of {len(new_files)} new, {len(changed_files)} changed and "
+          f"{len(removed_files)} removed sales files, {affected} customer/quarter groups recomputed")
 
-#register spark dataframe to duck db temp table.
-con.register('my_temp_table', new_results_df.toPandas())
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest the sales, customer and product files into DuckDB")
+    parser.add_argument('--full', action='store_true', help="Rebuild every table from all sales files")
+    args = parser.parse_args()
 
-#drop and recreate customers_order_amt table
-try:
-    con.execute("DROP TABLE customers_orders_amt")
-except:
-    pass
+    files = scan_sales_files()
+    #Fall back to a full rebuild until there is a manifest to compare with.
+    has_manifest = table_exists('INGESTED_FILES') and table_exists('CUSTOMER_ORDERS') and table_exists('customers_orders_amt')
+    if has_manifest and not args.full and stored_name_derivation_version() != NAME_DERIVATION_VERSION:
+        print("Customer names are derived differently since the last ingest, doing a full rebuild")
+        has_manifest = False
+    #One transaction per run, a run that fails leaves the tables and the manifest as they were.
+    con.begin()
+    try:
+        if args.full or not has_manifest:
+            full_ingest(files)
+        else:
+            incremental_ingest(files)
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
 
-con.execute("CREATE TABLE customers_orders_amt AS SELECT * FROM my_temp_table")
-con.close()
\ No newline at end of file
+    con.close()
\ No newline at end of file
@@ -0,0 +1,184 @@
+"""
+In-process DuckDB backend for the SQL generated for /chat (QUERY_BACKEND=duckdb).
+
+The generated queries run on DuckDB's vectorized engine against the pipeline
+output instead of Postgres. DUCKDB_SOURCE is either
+- Parquet files, e.g. clustered_customers.parquet or a glob like /data/*.parquet
+- a DuckDB database file such as my_database.db, read from DUCKDB_TABLE
+  (clustered_customers by default)
+
+Either way the source is exposed as a customer_data view with the same
+lowercase column names load_data.py gives the Postgres table, next to the
+customer_rollup_* views from load_data.CUSTOMER_DATA_ROLLUPS, so the same
+schema.json and prompt work on both backends. Chat history stays in Postgres.
+
+Queries go through the same read-only validation and row cap as on Postgres,
+with a timeout that interrupts the query. There is no EXPLAIN cost check, the
+estimates DuckDB gives are row counts, not costs. The database itself is an
+in-memory one with no access to files outside the source's folder and its
+configuration locked, so a query can't read or write anything else.
+
+A database file is opened read-only, but DuckDB still doesn't let the pipeline
+write to it while the app has it open. Point DUCKDB_SOURCE at the exported
+Parquet file to serve while the pipeline runs. The source is reopened when its
+files change, and the result cache is invalidated with it, see data_version.
+"""
+import glob
+import logging
+import os
+import threading
+
+import duckdb
+
+from load_data import CUSTOMER_DATA_ROLLUPS, TABLE_NAME, clean_column_name
+from query_governor import validate_read_only
+from query_results import (
+    build_summary_sql,
+    limit_sql,
+    log_summary_error,
+    make_result,
+    numeric_columns,
+    parse_summary,
+    quote_identifier,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class DuckDBBackend:
+    def __init__(self, source, table="clustered_customers", threads=None, memory_limit=None,
+                 max_rows=500, batch_size=200, summarize=True, timeout_ms=15000):
+        self.source = source
+        self.table = table
+        self.threads = threads
+        self.memory_limit = memory_limit
+        self.max_rows = max_rows
+        self.batch_size = batch_size
+        self.summarize = summarize
+        self.timeout_ms = timeout_ms
+        self.is_parquet = not source.endswith((".db", ".duckdb"))
+        self._connection = None
+        self._version = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def files(self):
+        return sorted(glob.glob(self.source)) if self.is_parquet else [self.source]
+
+    def data_version(self):
+        """
+        Version of the source files, changes whenever the pipeline rewrites them.
+        Used in place of the data_version table to key the result cache.
+        """
+        return max((os.stat(path).st_mtime_ns for path in self.files() if os.path.exists(path)), default=0)
+
+    def open(self):
+        # A fresh in-memory database with customer_data and the rollups as views over the source
+        files = [path for path in self.files() if os.path.exists(path)]
+        if not files:
+            raise FileNotFoundError(f"No DuckDB source found at {self.source}")
+        connection = duckdb.connect()
+        if self.threads:
+            connection.execute(f"SET threads = {int(self.threads)}")
+        if self.memory_limit:
+            connection.execute(f"SET memory_limit = '{self.memory_limit}'")
+        folder = os.path.dirname(os.path.abspath(files[0])) + os.sep
+        connection.execute(f"SET allowed_directories = ['{folder}']")
+
+        if self.is_parquet:
+            source_sql = f"read_parquet('{self.source}')"
+        else:
+            connection.execute(f"ATTACH '{self.source}' AS pipeline (READ_ONLY)")
+            source_sql = f"pipeline.{quote_identifier(self.table)}"
+        columns = [row[0] for row in connection.execute(f"DESCRIBE SELECT * FROM {source_sql}").fetchall()]
+        select_list = ", ".join(
+            f"{quote_identifier(column)} AS {quote_identifier(clean_column_name(column))}" for column in columns
+        )
+        connection.execute(f"CREATE VIEW {TABLE_NAME} AS SELECT {select_list} FROM {source_sql}")
+        for name, query in CUSTOMER_DATA_ROLLUPS.items():
+            connection.execute(f"CREATE VIEW {name} AS {query.format(table=TABLE_NAME)}")
+
+        connection.execute("SET enable_external_access = false")
+        connection.execute("SET lock_configuration = true")
+        return connection
+
+    def connection(self):
+        # The shared connection, reopened after a fork and when the source files change.
+        # Queries still running on the old one keep it alive until they finish.
+        version = self.data_version()
+        with self._lock:
+            if self._connection is None or self._pid != os.getpid() or self._version != version:
+                self._connection = self.open()
+                self._version = version
+                self._pid = os.getpid()
+                logger.info(f"Opened DuckDB source {self.source} (version {version})")
+            return self._connection
+
+    def reset(self):
+        # Forget a connection inherited from the preloading parent without closing it
+        with self._lock:
+            self._connection = None
+
+    def ping(self):
+        cursor = self.connection().cursor()
+        try:
+            cursor.execute(f"SELECT 1 FROM {TABLE_NAME} LIMIT 1").fetchall()
+        finally:
+            cursor.close()
+
+    def columns(self):
+        # Column names and types of customer_data, the DuckDB counterpart of app.load_catalog_columns
+        cursor = self.connection().cursor()
+        try:
+            return [(row[0], row[1]) for row in cursor.execute(f"DESCRIBE {TABLE_NAME}").fetchall()]
+        finally:
+            cursor.close()
+
+    def distinct_values(self, column):
+        # Distinct non-null values of a customer_data column, for the name index
+        cursor = self.connection().cursor()
+        try:
+            return [row[0] for row in cursor.execute(
+                f"SELECT DISTINCT {quote_identifier(column)} FROM {TABLE_NAME} "
+                f"WHERE {quote_identifier(column)} IS NOT NULL"
+            ).fetchall()]
+        finally:
+            cursor.close()
+
+    def run(self, sql_query):
+        """
+        Validate and run sql_query on its own cursor and return the result in
+        the query_results.py format. The query is interrupted after timeout_ms.
+        """
+        sql_query = validate_read_only(sql_query)
+        cursor = self.connection().cursor()
+        timer = threading.Timer(self.timeout_ms / 1000, cursor.interrupt) if self.timeout_ms else None
+        if timer:
+            timer.start()
+        try:
+            # Fetch one extra row to know whether the cap was hit
+            cursor.execute(limit_sql(sql_query, self.max_rows + 1))
+            columns = [column[0] for column in cursor.description]
+            rows = []
+            while True:
+                batch = cursor.fetchmany(self.batch_size)
+                if not batch:
+                    break
+                rows.extend(list(row) for row in batch)
+
+            query_result = make_result(columns, rows, self.max_rows)
+            if query_result["truncated"] and self.summarize:
+                numeric = numeric_columns(columns, query_result["rows"])
+                try:
+                    cursor.execute(build_summary_sql(sql_query, numeric))
+                    names = [column[0] for column in cursor.description]
+                    query_result["summary"] = parse_summary(dict(zip(names, cursor.fetchone())), numeric)
+                except duckdb.Error as e:
+                    log_summary_error(e)
+            return query_result
+        except duckdb.InterruptException:
+            raise TimeoutError(f"Query was cancelled after {self.timeout_ms}ms")
+        finally:
+            if timer:
+                timer.cancel()
+            cursor.close()
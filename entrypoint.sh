@@ -8,9 +8,15 @@ done
 
 echo "Postgres is up - initializing database"
 
-# Initialize fresh migrations
-flask db init
+# Create tables and apply startup migrations once, before any worker boots
+flask init-db
 
-# Start the application
-echo "Starting Flask application..."
-exec flask run --host=0.0.0.0 
\ No newline at end of file
+# Workers share their metrics through this folder, start it empty
+export PROMETHEUS_MULTIPROC_DIR="${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus}"
+rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
+# Start the application on the ASGI server, the chat routes run on the asyncio pipeline.
+# Worker count, timeout and preloading are set in gunicorn.conf.py
+echo "Starting application server..."
+exec gunicorn asgi:application -c gunicorn.conf.py
@@ -0,0 +1,43 @@
+"""
+Gunicorn settings for asgi:application, see entrypoint.sh.
+
+With WEB_PRELOAD=true (the default) the app is imported and warmed up once in
+the master process before the workers are forked, so every worker starts with
+the schema preamble and the Claude client already built. Database connections
+are not shared, each worker drops the ones it inherited and opens its own.
+
+With PROMETHEUS_MULTIPROC_DIR set every worker writes its metrics there and
+/metrics reports the sum over all workers, see metrics.py.
+"""
+import os
+
+bind = "0.0.0.0:5000"
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+timeout = int(os.getenv("WEB_TIMEOUT", "120"))
+preload_app = os.getenv("WEB_PRELOAD", "true").lower() == "true"
+
+
+def when_ready(server):
+    # Runs in the master before the first workers are forked
+    if preload_app:
+        from app import app, warm_up
+
+        with app.app_context():
+            checks = warm_up(check_database=False)
+        server.log.info(f"Warmed up before forking workers: {checks}")
+
+
+def post_fork(server, worker):
+    if preload_app:
+        from app import reset_after_fork
+
+        reset_after_fork()
+
+
+def child_exit(server, worker):
+    # Drop the live gauges of a worker that exited, its counters are kept
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
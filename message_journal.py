@@ -0,0 +1,194 @@
+"""
+Write-behind journal for chat messages.
+
+Requests put the rows to insert on an in-process queue and return without
+waiting for Postgres. A background thread drains the queue and inserts the rows
+in batches, one transaction per batch. When the queue is full the caller waits
+up to put_timeout and is then told to write the rows itself, so a slow database
+pushes back on requests instead of growing the queue without bound.
+
+This trades durability for latency, a message is not stored when the request
+returns:
+- a failed batch is retried with backoff for up to retry_seconds. Rows the
+  database still refuses are appended to spill_path and inserted after the
+  next batch that succeeds, or dropped with an error log without a spill_path
+- rows still queued are written when the process exits normally, not when it
+  is killed
+"""
+import atexit
+from datetime import datetime
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class MessageJournal:
+    """
+    Queue of message rows drained by a background batch writer.
+
+    insert_rows(rows) inserts a list of row dicts in one transaction and is
+    called from the writer thread.
+    """
+
+    def __init__(self, insert_rows, max_size=10000, batch_size=100, flush_interval=0.05,
+                 put_timeout=1.0, retry_seconds=60, spill_path=None):
+        self.insert_rows = insert_rows
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.retry_seconds = retry_seconds
+        self.spill_path = spill_path
+        self._queue = queue.Queue(maxsize=max_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._closed = False
+        atexit.register(self.close)
+
+    def _ensure_started(self):
+        # Start the writer lazily, and again in a worker forked after it was started
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(
+                    target=self._run, name="message-journal", daemon=True
+                )
+                self._thread.start()
+
+    def _running(self):
+        return self._thread is not None and self._thread.is_alive() and self._pid == os.getpid()
+
+    def write(self, rows, timeout=None):
+        """
+        Queue rows for insertion. Returns False if the journal is closed or the
+        queue stayed full for the timeout (put_timeout by default, 0 to not
+        wait), in which case the caller has to insert the rows itself.
+        """
+        if self._closed:
+            return False
+        self._ensure_started()
+        timeout = self.put_timeout if timeout is None else timeout
+        try:
+            self._queue.put(list(rows), block=timeout > 0, timeout=timeout or None)
+            return True
+        except queue.Full:
+            logger.warning(f"Message journal is full ({self._queue.maxsize} batches), writing inline")
+            return False
+
+    def flush(self, timeout=5.0):
+        """
+        Wait until the rows queued before this call have been written, not the
+        ones queued by other requests meanwhile. Returns False if that took
+        longer than timeout seconds.
+        """
+        if not self._running():
+            return True
+        # The writer sets the marker once it has written every batch queued ahead of it
+        marker = threading.Event()
+        try:
+            self._queue.put(marker, timeout=timeout)
+        except queue.Full:
+            return False
+        if not marker.wait(timeout):
+            logger.warning(f"Message journal flush timed out after {timeout}s")
+            return False
+        return True
+
+    def close(self):
+        """
+        Stop accepting rows, write everything still queued and stop the writer.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self._running():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            items = [self._queue.get()]
+            stopping = items[0] is None
+            row_count = len(items[0]) if isinstance(items[0], list) else 0
+
+            # Collect whatever else arrives within the flush interval, up to batch_size rows.
+            # A flush marker ends the batch so the flushing request doesn't wait for the interval
+            deadline = time.monotonic() + self.flush_interval
+            while not stopping and row_count < self.batch_size and isinstance(items[-1], list):
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                items.append(item)
+                if item is None:
+                    stopping = True
+                elif isinstance(item, list):
+                    row_count += len(item)
+
+            rows = [row for item in items if isinstance(item, list) for row in item]
+            if rows:
+                self._write_batch(rows)
+            for item in items:
+                if isinstance(item, threading.Event):
+                    item.set()
+
+    def _write_batch(self, rows):
+        # Retry with backoff for up to retry_seconds, then spill the rows
+        deadline = time.monotonic() + self.retry_seconds
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                self.insert_rows(rows)
+                break
+            except Exception as e:
+                logger.error(f"Error writing {len(rows)} journaled messages (attempt {attempt}): {str(e)}")
+                delay = min(2 ** attempt * 0.1, 5)
+                if time.monotonic() + delay > deadline:
+                    self._spill(rows)
+                    return
+                time.sleep(delay)
+        self._replay_spilled()
+
+    def _spill(self, rows):
+        if not self.spill_path:
+            logger.error(f"Dropped {len(rows)} journaled messages after {self.retry_seconds}s of retries")
+            return
+        try:
+            with open(self.spill_path, "a") as f:
+                for row in rows:
+                    f.write(json.dumps(row, default=str) + "\n")
+            logger.error(f"Spilled {len(rows)} journaled messages to {self.spill_path} after {self.retry_seconds}s of retries")
+        except OSError as e:
+            logger.error(f"Dropped {len(rows)} journaled messages, spilling them failed: {str(e)}")
+
+    def _replay_spilled(self):
+        # Insert the spilled rows once the database takes writes again. The file is renamed
+        # first so two workers don't both replay it, rows that fail again are spilled again.
+        if not self.spill_path or not os.path.exists(self.spill_path):
+            return
+        replaying = f"{self.spill_path}.{os.getpid()}"
+        try:
+            os.replace(self.spill_path, replaying)
+        except FileNotFoundError:
+            return
+        with open(replaying, "r") as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        for row in rows:
+            if isinstance(row.get("timestamp"), str):
+                row["timestamp"] = datetime.fromisoformat(row["timestamp"])
+        try:
+            if rows:
+                self.insert_rows(rows)
+            logger.info(f"Inserted {len(rows)} spilled messages from {self.spill_path}")
+        except Exception as e:
+            logger.error(f"Error inserting {len(rows)} spilled messages: {str(e)}")
+            self._spill(rows)
+        os.remove(replaying)
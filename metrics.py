@@ -0,0 +1,136 @@
+"""
+Per-stage timings and counters for the chat pipeline, exposed on /metrics.
+
+Each request gets a RequestTimings and wraps its stages in timings.span(name):
+
+    schema          load_schema
+    cache_lookup    result cache lookup
+    followup_context  session turns for a follow-up question
+    name_resolution customer names in the question matched to exact names
+    prompt_build    SQL generation prompt
+    llm_sql         Claude writing the SQL
+    sql_extract     pulling the SQL out of the response
+    query           governor checks and Postgres execution
+    serialize       analysis prompt and query_info encoding
+    local_format    template answer for trivial results
+    llm_analysis    Claude explaining the results
+    llm_followup    Claude answering a follow-up question
+    db_write        handing messages to the journal
+
+Spans feed the chat_stage_seconds histogram and, when the client asks for it,
+a per-request breakdown in the response. Prompt and response sizes, query row
+counts and cache hits have their own histograms and counters.
+
+With PROMETHEUS_MULTIPROC_DIR set (see gunicorn.conf.py) /metrics aggregates
+every worker process, otherwise it reports the current process.
+"""
+from contextlib import contextmanager
+import os
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+)
+from prometheus_client import multiprocess
+
+STAGE_SECONDS = Histogram(
+    "chat_stage_seconds",
+    "Duration of each chat pipeline stage",
+    ["stage"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+STAGE_ERRORS = Counter("chat_stage_errors_total", "Chat pipeline stages that raised", ["stage"])
+REQUEST_SECONDS = Histogram(
+    "chat_request_seconds",
+    "Duration of HTTP requests by endpoint",
+    ["endpoint"],
+    buckets=(0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+REQUESTS = Counter("chat_requests_total", "HTTP requests by endpoint and status", ["endpoint", "status"])
+LLM_PROMPT_CHARS = Histogram(
+    "chat_llm_prompt_chars",
+    "Characters sent to Claude per call",
+    ["stage"],
+    buckets=(250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000),
+)
+LLM_RESPONSE_CHARS = Histogram(
+    "chat_llm_response_chars",
+    "Characters received from Claude per call",
+    ["stage"],
+    buckets=(50, 100, 250, 500, 1000, 2500, 5000, 10000),
+)
+QUERY_ROWS = Histogram(
+    "chat_query_rows",
+    "Rows returned by generated queries, after the row cap",
+    buckets=(0, 1, 5, 10, 50, 100, 250, 500, 1000, 5000),
+)
+QUERY_TRUNCATED = Counter("chat_query_truncated_total", "Generated queries that hit the row cap")
+CACHE_EVENTS = Counter("chat_cache_events_total", "Cache lookups by cache and result", ["cache", "result"])
+
+
+class RequestTimings:
+    """
+    Stage durations of one request, recorded to the histograms as they finish.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            STAGE_ERRORS.labels(stage).inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            STAGE_SECONDS.labels(stage).observe(elapsed)
+            # Stages that run more than once in a request, like db_write, add up
+            self.stages[stage] = self.stages.get(stage, 0.0) + elapsed
+
+    def breakdown(self):
+        """
+        Per-stage and total milliseconds for the response.
+        """
+        return {
+            "stages_ms": {stage: round(seconds * 1000, 2) for stage, seconds in self.stages.items()},
+            "total_ms": round((time.perf_counter() - self.start) * 1000, 2),
+        }
+
+
+def observe_llm(stage, prompt, response):
+    LLM_PROMPT_CHARS.labels(stage).observe(len(prompt))
+    LLM_RESPONSE_CHARS.labels(stage).observe(len(response))
+
+
+def observe_query(query_result):
+    QUERY_ROWS.observe(query_result["row_count"])
+    if query_result["truncated"]:
+        QUERY_TRUNCATED.inc()
+
+
+def observe_cache(cache, hit):
+    CACHE_EVENTS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def observe_request(endpoint, status, seconds):
+    REQUESTS.labels(endpoint, str(status)).inc()
+    REQUEST_SECONDS.labels(endpoint).observe(seconds)
+
+
+def render_metrics():
+    """
+    Return (body, content_type) in the Prometheus text format.
+    """
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
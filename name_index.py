@@ -0,0 +1,265 @@
+"""
+In-memory fuzzy index of the distinct customer names in customer_data.
+
+Names are indexed by their trigrams, the same way pg_trgm splits words. A
+lookup scores every name that shares a trigram with the search term by the
+share of the term's trigrams found in the name, then by the share of the
+name's trigrams found in the term, so misspellings ("westmont") and
+abbreviations ("westmount hosp") still find "Westmount Hospital". Words many
+names share, like "clinic" or "hospital", don't count towards the share of the
+name a term covers, so "clinic" alone doesn't pin down "Mayo Clinic".
+
+resolve_names() looks for the customer names mentioned in a question before
+the SQL is generated. A mention covering most of a name is resolved to that
+exact name, and the prompt asks for customer_name = '...' on an indexed column
+instead of an unanchored LIKE scan that returns nothing for a misspelled name.
+A mention covering only part of the names it is found in ("texas" in "Texas
+Childrens Hospital") is only passed on as possible names. Words that are a
+state, province, city, member type or product category are never taken for a
+customer name.
+
+NameIndexCache keeps one index per customer_data version and rebuilds it when
+the table is reloaded. Requests keep using the previous index while it rebuilds.
+"""
+from collections import defaultdict
+import logging
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_NON_ALPHANUMERIC = re.compile(r"[^0-9a-z]+")
+_POSSESSIVE = re.compile(r"['\u2019]s\b")
+
+# Words that never start or end a name mention in a question
+QUESTION_WORDS = {
+    "a", "about", "all", "amount", "and", "any", "are", "average", "by", "can", "compare", "compared",
+    "count", "customer", "customers", "did", "do", "does", "each", "for", "from", "give", "has", "have",
+    "how", "in", "is", "it", "last", "list", "many", "me", "most", "much", "number", "of", "on", "or",
+    "order", "orders", "our", "per", "q1", "q2", "q3", "q4", "quantity", "quarter", "quarters", "sales",
+    "show", "spend", "spent", "state", "the", "their", "this", "to", "top", "total", "vs", "was", "were",
+    "what", "which", "who", "with", "year", "years",
+}
+
+# Words found in the names of many kinds of customers, they don't tell one customer from another
+COMMON_NAME_WORDS = {
+    "and", "assoc", "associates", "care", "center", "centre", "clinic", "clinics", "co", "college",
+    "company", "corp", "corporation", "foundation", "group", "health", "healthcare", "hospital",
+    "hospitals", "inc", "institute", "lab", "laboratories", "laboratory", "labs", "llc", "ltd",
+    "medical", "of", "pharmacy", "services", "system", "the", "university",
+}
+
+# US states and Canadian provinces spelled out, customer_state only holds their codes
+REGION_NAMES = {
+    "alabama", "alaska", "arizona", "arkansas", "california", "colorado", "connecticut", "delaware",
+    "district of columbia", "florida", "georgia", "hawaii", "idaho", "illinois", "indiana", "iowa",
+    "kansas", "kentucky", "louisiana", "maine", "maryland", "massachusetts", "michigan", "minnesota",
+    "mississippi", "missouri", "montana", "nebraska", "nevada", "new hampshire", "new jersey", "new mexico",
+    "new york", "north carolina", "north dakota", "ohio", "oklahoma", "oregon", "pennsylvania",
+    "rhode island", "south carolina", "south dakota", "tennessee", "texas", "utah", "vermont", "virginia",
+    "washington", "west virginia", "wisconsin", "wyoming", "alberta", "british columbia", "manitoba",
+    "new brunswick", "newfoundland", "nova scotia", "ontario", "quebec", "saskatchewan", "yukon",
+}
+
+
+def normalize_name(name):
+    # Lowercase without possessives ("mayo's" is "mayo") and apostrophes, every other run of
+    # punctuation and whitespace turned into one space
+    name = _POSSESSIVE.sub("", str(name).lower()).replace("'", "").replace("\u2019", "")
+    return _NON_ALPHANUMERIC.sub(" ", name).strip()
+
+
+def word_trigrams(word):
+    # Trigrams of a word padded with two spaces in front and one behind, like pg_trgm
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def trigrams(text):
+    # Trigrams of each word of text
+    grams = set()
+    for word in normalize_name(text).split():
+        grams |= word_trigrams(word)
+    return grams
+
+
+class NameIndex:
+    """
+    Trigram index of names. Fuzzy lookups only consider the names sharing a
+    rare trigram with the term, trigrams found in more than common_share of
+    the names (from words like "hospital" or "inc") say little about which
+    name is meant.
+
+    The share of a name a term covers is measured on the name's distinctive
+    words, leaving out COMMON_NAME_WORDS and words found in as many names as
+    a common trigram. A name made only of such words is measured whole.
+
+    other_terms are the other values a question can name, such as states and
+    product categories. resolve_names() doesn't match them to customer names.
+    """
+
+    def __init__(self, names, other_terms=(), common_share=0.1):
+        self.names = sorted({name for name in names if name and normalize_name(name)})
+        self.other_terms = {normalize_name(term) for term in other_terms if term} | REGION_NAMES
+        self._max_postings = max(int(len(self.names) * common_share), 100)
+        self._exact = {}
+        self._grams = []
+        self._postings = defaultdict(list)
+        word_counts = defaultdict(int)
+        for position, name in enumerate(self.names):
+            self._exact.setdefault(normalize_name(name), []).append(name)
+            grams = trigrams(name)
+            self._grams.append(grams)
+            for gram in grams:
+                self._postings[gram].append(position)
+            for word in set(normalize_name(name).split()):
+                word_counts[word] += 1
+        self._distinctive_grams = []
+        for name, grams in zip(self.names, self._grams):
+            distinctive = set()
+            for word in normalize_name(name).split():
+                if word not in COMMON_NAME_WORDS and word_counts[word] <= self._max_postings:
+                    distinctive |= word_trigrams(word)
+            self._distinctive_grams.append(distinctive or grams)
+
+    def __len__(self):
+        return len(self.names)
+
+    def search(self, term, limit=5, min_score=0.5):
+        """
+        Names matching term as [(name, score, name_coverage)], best first.
+        score is the share of the term's trigrams found in the name and
+        name_coverage the share of the name's distinctive trigrams found in the
+        term. An exact match (ignoring case and punctuation) scores 1.0 on both.
+        """
+        exact = self._exact.get(normalize_name(term))
+        if exact:
+            return [(name, 1.0, 1.0) for name in exact[:limit]]
+
+        term_grams = trigrams(term)
+        candidates = set()
+        for gram in term_grams:
+            postings = self._postings.get(gram, ())
+            if len(postings) <= self._max_postings:
+                candidates.update(postings)
+
+        matches = []
+        for position in candidates:
+            count = len(term_grams & self._grams[position])
+            coverage = count / len(term_grams)
+            if coverage < min_score:
+                continue
+            distinctive = self._distinctive_grams[position]
+            name_coverage = len(term_grams & distinctive) / len(distinctive)
+            matches.append((coverage, name_coverage, self.names[position]))
+        matches.sort(key=lambda match: (-match[0], -match[1], match[2]))
+        return [
+            (name, round(coverage, 3), round(name_coverage, 3))
+            for coverage, name_coverage, name in matches[:limit]
+        ]
+
+
+def candidate_spans(question, max_words=5):
+    # Runs of up to max_words words of the question that don't start or end with a question word
+    words = normalize_name(question).split()
+    spans = []
+    for start in range(len(words)):
+        for end in range(start + 1, min(start + max_words, len(words)) + 1):
+            if words[start] in QUESTION_WORDS or words[end - 1] in QUESTION_WORDS:
+                continue
+            spans.append((start, end, " ".join(words[start:end])))
+    return spans
+
+
+def category_terms(columns):
+    # Product categories of the per-category count columns, "critical care" for critical_care_count
+    return [
+        column[:-len("_count")].replace("_", " ")
+        for column in (str(column).lower() for column in columns)
+        if column.endswith("_count")
+    ]
+
+
+def resolve_names(index, question, min_score=0.75, min_name_coverage=0.5, max_candidates=3, max_mentions=3):
+    """
+    Customer names mentioned in question as [{"mention", "names", "partial"}],
+    where "names" are the best matching exact names in the index. "partial"
+    is True when the mention covers less than min_name_coverage of those
+    names, they are then only candidates. Full mentions win over partial
+    ones and longer mentions over the shorter ones they overlap.
+    """
+    if index is None or not len(index):
+        return []
+    spans = candidate_spans(question)
+    # States, cities, member types and product categories, even when a customer is named after
+    # one, and the words in them
+    other = [(start, end) for start, end, span in spans if span in index.other_terms]
+    found = []
+    for start, end, span in spans:
+        # Short words and bare numbers match too many names by accident
+        if end - start == 1 and len(span) < 4 or span.replace(" ", "").isdigit():
+            continue
+        if any(other_start <= start and end <= other_end for other_start, other_end in other):
+            continue
+        matches = index.search(span, limit=max_candidates + 1, min_score=min_score)
+        if not matches:
+            continue
+        # Keep only the candidates as good as the best one, a mention that
+        # fits more names than that is too vague to pin down
+        names = [name for name, score, _ in matches if score >= matches[0][1] - 0.05]
+        if len(names) <= max_candidates:
+            partial = matches[0][2] < min_name_coverage
+            # Rank mentions by how much of the question they explain
+            found.append((not partial, matches[0][1] * len(span), start, end, span, names))
+
+    resolved = []
+    taken = set()
+    for full, weight, start, end, span, names in sorted(
+        found, key=lambda item: (-item[0], -item[1], item[2])
+    ):
+        if taken.intersection(range(start, end)):
+            continue
+        taken.update(range(start, end))
+        resolved.append({"mention": span, "names": names, "partial": not full})
+        if len(resolved) == max_mentions:
+            break
+    return resolved
+
+
+class NameIndexCache:
+    """
+    The NameIndex of the current customer_data version.
+    """
+
+    def __init__(self):
+        self._index = None
+        self._version = None
+        self._building = False
+        self._lock = threading.Lock()
+
+    def get(self, data_version, build_index):
+        """
+        Return the index for data_version, building it with build_index() if
+        needed. While another thread rebuilds it the previous index is returned.
+        """
+        with self._lock:
+            if self._version == data_version and self._index is not None:
+                return self._index
+            if self._building and self._index is not None:
+                return self._index
+            self._building = True
+        try:
+            start = time.perf_counter()
+            index = build_index()
+            logger.info(
+                f"Built customer name index with {len(index)} names for data version {data_version} "
+                f"in {time.perf_counter() - start:.2f}s"
+            )
+            with self._lock:
+                self._index = index
+                self._version = data_version
+            return index
+        finally:
+            with self._lock:
+                self._building = False
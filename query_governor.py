@@ -0,0 +1,132 @@
+"""
+Safety and cost guard for the SQL generated for /chat.
+
+Before a query reaches fetch_bounded_async it is:
+- checked to be a single statement starting with SELECT or WITH, with comments,
+  string literals and quoted identifiers masked out first. A WITH query can't
+  hold an INSERT, UPDATE, DELETE or MERGE. Only the statement keywords are
+  checked, so columns and aliases like "cluster" or "set" are fine
+- given a transaction-local statement_timeout
+- planned with EXPLAIN. A query whose estimated cost is above max_cost is
+  rewritten to its capped (LIMIT) form if that plan is cheap enough, and runs
+  without the full-result summary. Otherwise it is rejected before it runs.
+
+The query connections themselves come from a separate, small pool opened with
+default_transaction_read_only, see app.create_query_engine. That is what refuses
+SELECT ... INTO and row locks on Postgres.
+"""
+import json
+import logging
+import re
+
+from sqlalchemy import text
+
+from query_results import fetch_bounded_async, limit_sql, strip_sql
+
+logger = logging.getLogger(__name__)
+
+_COMMENTS = re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL)
+_STRINGS = re.compile(r"'(?:[^']|'')*'|\$(\w*)\$.*?\$\1\$|\"(?:[^\"]|\"\")*\"", re.DOTALL)
+_FIRST_WORD = re.compile(r"^\s*\(*\s*(\w+)")
+
+# A data-modifying statement in a WITH query, as a CTE body or as the statement after the CTEs
+_WRITE_STATEMENT = re.compile(r"[()]\s*(INSERT|UPDATE|DELETE|MERGE)\b", re.IGNORECASE)
+
+# Functions that sleep, touch the server's files or other sessions
+_FORBIDDEN_FUNCTIONS = re.compile(
+    r"\b(pg_sleep\w*|pg_read_\w+|pg_ls_\w+|pg_stat_file|lo_\w+|dblink\w*|pg_terminate_backend|"
+    r"pg_cancel_backend|pg_advisory\w*|pg_reload_conf|pg_rotate_logfile|set_config|"
+    r"current_setting|query_to_xml\w*)\s*\(",
+    re.IGNORECASE,
+)
+
+SET_STATEMENT_TIMEOUT = text("SELECT set_config('statement_timeout', :timeout, true)")
+
+
+class QueryRejected(ValueError):
+    """
+    The generated query is not read-only or is estimated to be too expensive.
+    """
+
+
+def mask_sql(sql_query):
+    # Blank out comments, literals and quoted identifiers so keywords inside them don't count
+    return _STRINGS.sub("''", _COMMENTS.sub(" ", sql_query))
+
+
+def validate_read_only(sql_query):
+    """
+    Return sql_query without its trailing semicolon if it is a single
+    read-only statement, raise QueryRejected otherwise.
+    """
+    sql_query = strip_sql(sql_query)
+    masked = mask_sql(sql_query)
+
+    if ";" in masked:
+        raise QueryRejected("Only a single SQL statement can be run")
+    first_word = _FIRST_WORD.match(masked)
+    if not first_word or first_word.group(1).upper() not in ("SELECT", "WITH"):
+        raise QueryRejected("Only SELECT queries can be run")
+    if first_word.group(1).upper() == "WITH":
+        statement = _WRITE_STATEMENT.search(masked)
+        if statement:
+            raise QueryRejected(f"Queries can't use {statement.group(1).upper()}")
+    function = _FORBIDDEN_FUNCTIONS.search(masked)
+    if function:
+        raise QueryRejected(f"Queries can't call {function.group(1)}")
+    return sql_query
+
+
+def parse_plan(plan):
+    # Estimated total cost and rows of the top node of an EXPLAIN (FORMAT JSON) plan
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    top = plan[0]["Plan"]
+    return {"cost": top["Total Cost"], "rows": top["Plan Rows"]}
+
+
+def explain_sql(sql_query):
+    return f"EXPLAIN (FORMAT JSON) {sql_query}"
+
+
+def check_estimate(sql_query, estimate, limited_estimate, max_cost):
+    """
+    Decide how to run a query from its plan estimates. Returns True if it can
+    run with the full-result summary, False if only the capped query is cheap
+    enough, and raises QueryRejected if neither is.
+    """
+    if estimate["cost"] <= max_cost:
+        return True
+    if limited_estimate is not None and limited_estimate["cost"] <= max_cost:
+        logger.warning(
+            f"Query estimated at cost {estimate['cost']:,.0f} ({estimate['rows']:,} rows), "
+            f"running capped without summary: {sql_query}"
+        )
+        return False
+    cost = (limited_estimate or estimate)["cost"]
+    raise QueryRejected(
+        f"Query is too expensive to run (estimated cost {cost:,.0f}, limit {max_cost:,.0f}), "
+        f"try narrowing it down with filters or aggregates"
+    )
+
+
+async def run_governed_async(connection, sql_query, max_rows=500, batch_size=200, summarize=True,
+                             max_cost=1000000, statement_timeout_ms=15000):
+    """
+    Validate, time-limit and cost-check sql_query, then run it with
+    fetch_bounded_async on an AsyncConnection. EXPLAIN and statement_timeout
+    are only used on Postgres.
+    """
+    sql_query = validate_read_only(sql_query)
+    if connection.dialect.name == "postgresql":
+        await connection.execute(SET_STATEMENT_TIMEOUT, {"timeout": f"{statement_timeout_ms}ms"})
+        if max_cost:
+            estimate = parse_plan(await connection.scalar(text(explain_sql(sql_query))))
+            limited_estimate = None
+            if estimate["cost"] > max_cost:
+                limited_sql = limit_sql(sql_query, max_rows + 1)
+                limited_estimate = parse_plan(await connection.scalar(text(explain_sql(limited_sql))))
+            summarize = check_estimate(sql_query, estimate, limited_estimate, max_cost) and summarize
+    return await fetch_bounded_async(
+        connection, sql_query, max_rows=max_rows, batch_size=batch_size, summarize=summarize
+    )
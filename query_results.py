@@ -0,0 +1,117 @@
+"""
+Bounded execution of the SQL generated for /chat.
+
+Queries are capped by wrapping them in an outer LIMIT, read through a server-side cursor
+in batches and returned in a compact columnar form:
+
+    {
+        "columns": ["customer_name", "total_order_amount"],
+        "rows": [["Acme", 1200.5], ...],
+        "row_count": 2,
+        "truncated": False,
+        "summary": None,
+    }
+
+When the query returns more than max_rows rows, only the first max_rows are
+kept and "summary" holds the total row count and min/max/avg of every numeric
+column, computed by Postgres over the full result.
+"""
+from decimal import Decimal
+import logging
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+
+def strip_sql(sql_query):
+    return sql_query.strip().rstrip(";").strip()
+
+
+def limit_sql(sql_query, limit):
+    # Cap the query at `limit` rows whatever LIMIT, FETCH FIRST or trailing comment it ends with.
+    # The query goes on its own lines so a trailing -- comment can't swallow the closing parenthesis
+    return f"SELECT * FROM (\n{strip_sql(sql_query)}\n) AS bounded\nLIMIT {int(limit)}"
+
+
+def quote_identifier(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def is_numeric(value):
+    return isinstance(value, (int, float, Decimal)) and not isinstance(value, bool)
+
+
+def numeric_columns(columns, rows):
+    # Columns whose non-null values are all numbers in the rows we kept
+    numeric = []
+    for index, column in enumerate(columns):
+        values = [row[index] for row in rows if row[index] is not None]
+        if values and all(is_numeric(value) for value in values):
+            numeric.append(column)
+    return numeric
+
+
+def build_summary_sql(sql_query, numeric):
+    # Aggregate the full, uncapped result on the database side
+    aggregates = ["COUNT(*) AS total_rows"]
+    for index, column in enumerate(numeric):
+        quoted = quote_identifier(column)
+        aggregates.append(
+            f"MIN({quoted}) AS min_{index}, MAX({quoted}) AS max_{index}, AVG({quoted}) AS avg_{index}"
+        )
+    return f"SELECT {', '.join(aggregates)} FROM (\n{strip_sql(sql_query)}\n) AS capped_query"
+
+
+def parse_summary(row, numeric):
+    summary = {"total_rows": row["total_rows"], "columns": {}}
+    for index, column in enumerate(numeric):
+        summary["columns"][column] = {
+            "min": row[f"min_{index}"],
+            "max": row[f"max_{index}"],
+            "avg": row[f"avg_{index}"],
+        }
+    return summary
+
+
+def log_summary_error(error):
+    # The summary is extra information, e.g. duplicate column names make it fail while the rows are fine
+    logger.warning(f"Skipped the summary of a capped result: {str(error)}")
+
+
+def make_result(columns, rows, max_rows):
+    truncated = len(rows) > max_rows
+    rows = rows[:max_rows]
+    return {
+        "columns": columns,
+        "rows": rows,
+        "row_count": len(rows),
+        "truncated": truncated,
+        "summary": None,
+    }
+
+
+async def fetch_bounded_async(connection, sql_query, max_rows=500, batch_size=200, summarize=True):
+    """
+    Run sql_query on an AsyncConnection and return at most max_rows rows in columnar form.
+    """
+    # Fetch one extra row to know whether the cap was hit
+    result = await connection.stream(
+        text(limit_sql(sql_query, max_rows + 1)),
+        execution_options={"max_row_buffer": batch_size},
+    )
+    columns = list(result.keys())
+    rows = []
+    async for partition in result.partitions(batch_size):
+        rows.extend(list(row) for row in partition)
+    await result.close()
+
+    query_result = make_result(columns, rows, max_rows)
+    if query_result["truncated"] and summarize:
+        numeric = numeric_columns(columns, query_result["rows"])
+        try:
+            row = (await connection.execute(text(build_summary_sql(sql_query, numeric)))).mappings().one()
+            query_result["summary"] = parse_summary(row, numeric)
+        except Exception as e:
+            log_summary_error(e)
+    return query_result
@@ -0,0 +1,81 @@
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+
+# Words that don't change what a question asks for, dropped so that
+# "Can you show me the total sales for Acme?" and "total sales for acme"
+# share a cache entry.
+FILLER_WORDS = {"a", "an", "the", "please", "can", "could", "you", "show", "me", "tell"}
+
+_PUNCTUATION = re.compile(r"[^\w\s%]")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_question(question):
+    # Lowercase, strip punctuation and filler words, collapse whitespace
+    words = _PUNCTUATION.sub(" ", question.lower())
+    return " ".join(w for w in _WHITESPACE.split(words) if w and w not in FILLER_WORDS)
+
+
+class ResultCache:
+    """
+    Thread-safe LRU cache with a TTL for answers produced by the /chat SQL pipeline.
+
+    Entries are keyed on the normalized question, the schema hash and the
+    version of the customer_data table, so a reload of the table or an edit of
+    schema.json never serves a stale answer.
+    """
+
+    def __init__(self, max_entries=256, ttl_seconds=900):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._data_version = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(question, schema_hash, data_version):
+        raw = f"{normalize_question(question)}|{schema_hash}|{data_version}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def sync_data_version(self, data_version):
+        # Drop every entry as soon as we see a new customer_data version
+        with self._lock:
+            if self._data_version is not None and self._data_version != data_version:
+                self._entries.clear()
+            self._data_version = data_version
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,129 @@
+"""
+Encoders that turn a query result (see query_results.py) into prompt text.
+
+The default "table" encoder writes a header row followed by one line of values
+per row, which is a fraction of the size of pretty-printed JSON with repeated
+keys. compact_result() keeps the encoded text under a token budget by sending an
+evenly spaced sample of the rows, and reports how much smaller the prompt got.
+"""
+from decimal import Decimal
+import json
+
+
+def estimate_tokens(text):
+    # Rough token estimate, ~4 characters per token for English and numbers
+    return (len(text) + 3) // 4
+
+
+def format_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, (float, Decimal)) and not isinstance(value, bool):
+        return f"{value:.4f}".rstrip("0").rstrip(".")
+    return str(value).replace("|", "\\|").replace("\n", " ")
+
+
+def format_summary(summary):
+    lines = [f"Total rows in full result: {summary['total_rows']}"]
+    for column, stats in summary["columns"].items():
+        lines.append(
+            f"{column}: min {format_value(stats['min'])}, max {format_value(stats['max'])}, avg {format_value(stats['avg'])}"
+        )
+    return "\n".join(lines)
+
+
+def encode_table(columns, rows, summary=None):
+    lines = [" | ".join(str(column) for column in columns)]
+    lines.extend(" | ".join(format_value(value) for value in row) for row in rows)
+    if summary:
+        lines.append("")
+        lines.append(format_summary(summary))
+    return "\n".join(lines)
+
+
+def encode_json(columns, rows, summary=None):
+    payload = {"columns": columns, "rows": rows}
+    if summary:
+        payload["summary"] = summary
+    return json.dumps(payload, default=str, separators=(",", ":"))
+
+
+ENCODERS = {
+    "table": encode_table,
+    "json": encode_json,
+}
+
+
+def register_encoder(name, encoder):
+    # encoder(columns, rows, summary=None) -> str
+    ENCODERS[name] = encoder
+
+
+def sample_rows(rows, count):
+    # Evenly spaced sample that always keeps the first row
+    if count >= len(rows):
+        return rows
+    if count <= 0:
+        return []
+    step = len(rows) / count
+    return [rows[int(i * step)] for i in range(count)]
+
+
+def estimate_baseline_tokens(columns, rows, sample_size=50):
+    """
+    Estimated tokens of what the prompt used to embed, the records as indented
+    JSON, from the column names and the average value length of a sample of the
+    rows instead of serializing every row on each request.
+    """
+    if not rows:
+        return estimate_tokens("[]")
+    sample = sample_rows(rows, sample_size)
+    # Quoted values, ~2 characters more than their table form
+    value_chars = sum(len(format_value(value)) + 2 for row in sample for value in row) / len(sample)
+    # '    "column": ' and ',\n' around each value, '  {\n' and '  },\n' around each row
+    key_chars = sum(len(str(column)) + 10 for column in columns)
+    return (int(len(rows) * (value_chars + key_chars + 9)) + 3) // 4
+
+
+def compact_result(query_result, token_budget=2000, encoder="table"):
+    """
+    Encode query_result for the analysis prompt within token_budget tokens.
+
+    Returns (text, stats) where stats reports the rows sent and the estimated
+    token count before and after compaction.
+    """
+    encode = ENCODERS[encoder]
+    columns = query_result["columns"]
+    rows = query_result["rows"]
+    summary = query_result.get("summary")
+    total_rows = summary["total_rows"] if summary else query_result["row_count"]
+
+    # Find the largest sample that fits the budget, leaving room for the sample note
+    sent = rows
+    encoded = encode(columns, sent, summary)
+    if estimate_tokens(encoded) > token_budget:
+        token_budget -= 16
+        low, high = 0, len(rows)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if estimate_tokens(encode(columns, sample_rows(rows, middle), summary)) <= token_budget:
+                low = middle
+            else:
+                high = middle - 1
+        sent = sample_rows(rows, low)
+        encoded = encode(columns, sent, summary)
+
+    if len(sent) < total_rows:
+        encoded += f"\n(Showing a sample of {len(sent)} of {total_rows} rows)"
+
+    original_tokens = estimate_baseline_tokens(columns, rows)
+    encoded_tokens = estimate_tokens(encoded)
+    stats = {
+        "encoder": encoder,
+        "rows_total": total_rows,
+        "rows_sent": len(sent),
+        "original_tokens": original_tokens,
+        "encoded_tokens": encoded_tokens,
+        "compression_ratio": round(original_tokens / encoded_tokens, 2) if encoded_tokens else None,
+    }
+    return encoded, stats
@@ -0,0 +1,99 @@
+"""
+Local answers for query results that don't need an LLM to explain them.
+
+classify_result() sorts a query result (see query_results.py) by shape:
+
+    empty        no rows
+    scalar       one row with one column, e.g. a total or a count
+    single_row   one row with several columns, e.g. a customer lookup
+    small_table  up to SMALL_TABLE_MAX_ROWS rows, not truncated
+    large_table  anything bigger
+
+format_locally() renders the shapes it is allowed to from a fixed template and
+returns None for the rest, which are sent to Claude for analysis as before.
+"""
+from datetime import date, datetime
+from decimal import Decimal
+
+SMALL_TABLE_MAX_ROWS = 10
+
+# Integer columns shown without a thousands separator
+_PLAIN_INTEGER_SUFFIXES = ("year", "quarter", "month", "id")
+
+
+def classify_result(query_result):
+    rows = query_result["rows"]
+    if not rows:
+        return "empty"
+    if len(rows) == 1 and not query_result["truncated"]:
+        return "scalar" if len(query_result["columns"]) == 1 else "single_row"
+    if len(rows) <= SMALL_TABLE_MAX_ROWS and not query_result["truncated"]:
+        return "small_table"
+    return "large_table"
+
+
+def column_label(column):
+    return str(column).replace("_", " ").strip().capitalize()
+
+
+def format_value(column, value):
+    if value is None:
+        return "no value"
+    if isinstance(value, bool):
+        return "yes" if value else "no"
+    if isinstance(value, int):
+        if str(column).lower().endswith(_PLAIN_INTEGER_SUFFIXES):
+            return str(value)
+        return f"{value:,}"
+    if isinstance(value, (float, Decimal)):
+        return f"{value:,.2f}"
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return str(value)
+
+
+def format_empty(columns, rows):
+    return "The query returned no rows, so there is no data matching that question."
+
+
+def format_scalar(columns, rows):
+    return f"{column_label(columns[0])}: {format_value(columns[0], rows[0][0])}"
+
+
+def format_single_row(columns, rows):
+    lines = ["Here is the matching record:"]
+    lines.extend(
+        f"- {column_label(column)}: {format_value(column, value)}"
+        for column, value in zip(columns, rows[0])
+    )
+    return "\n".join(lines)
+
+
+def format_small_table(columns, rows):
+    lines = [f"The query returned {len(rows)} rows:"]
+    for row in rows:
+        lines.append(
+            "- " + ", ".join(
+                f"{column_label(column)}: {format_value(column, value)}"
+                for column, value in zip(columns, row)
+            )
+        )
+    return "\n".join(lines)
+
+
+TEMPLATES = {
+    "empty": format_empty,
+    "scalar": format_scalar,
+    "single_row": format_single_row,
+    "small_table": format_small_table,
+}
+
+
+def format_locally(query_result, shapes=("empty", "scalar", "single_row")):
+    """
+    Return a template answer if the result's shape is in shapes, otherwise None.
+    """
+    shape = classify_result(query_result)
+    if shape not in shapes or shape not in TEMPLATES:
+        return None
+    return TEMPLATES[shape](query_result["columns"], query_result["rows"])
@@ -0,0 +1,119 @@
+"""
+Precompiled schema preamble for the SQL generation prompt.
+
+schema.json is parsed and validated once, duplicate columns are dropped and the
+columns are rendered as one compact line each. The result is kept in memory and
+rebuilt only when the file's mtime changes, or when the customer_data version
+changes if the preamble is generated from the live Postgres catalog.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def validate_schema(schema):
+    # Check the schema shape and drop duplicate columns, later entries win
+    if not isinstance(schema, dict) or not isinstance(schema.get("columns"), list):
+        raise ValueError("schema.json must be an object with a 'columns' list")
+
+    columns = {}
+    for column in schema["columns"]:
+        if not column.get("column_name") or not column.get("data_type"):
+            raise ValueError(f"Schema column is missing column_name or data_type: {column}")
+        key = column["column_name"].lower()
+        if key in columns:
+            logger.warning(f"Duplicate schema column {column['column_name']}, keeping the last definition")
+            del columns[key]
+        columns[key] = column
+
+    return {**schema, "columns": list(columns.values())}
+
+
+def render_preamble(schema):
+    lines = []
+    if schema.get("description"):
+        lines.append(schema["description"])
+    lines.append("Columns (name type: description):")
+    for column in schema["columns"]:
+        line = f"- {column['column_name']} {column['data_type']}"
+        if column.get("description"):
+            line += f": {column['description']}"
+        lines.append(line)
+    if schema.get("rollups"):
+        lines.append("")
+        lines.append("Pre-aggregated views of customer_data (prefer these for totals by cluster, state or quarter):")
+        for rollup in schema["rollups"]:
+            lines.append(f"- {rollup['name']}: {rollup['description']} Columns: {', '.join(rollup['columns'])}")
+    return "\n".join(lines)
+
+
+def merge_catalog(schema, catalog_columns):
+    # Use the live column names and types, with descriptions from schema.json where they match
+    descriptions = {c["column_name"].lower(): c.get("description", "") for c in schema["columns"]}
+    return {
+        **schema,
+        "columns": [
+            {
+                "column_name": name,
+                "data_type": data_type.upper(),
+                "description": descriptions.get(name.lower(), ""),
+            }
+            for name, data_type in catalog_columns
+        ],
+    }
+
+
+class SchemaPrompt:
+    """
+    In-memory cache of the rendered schema preamble and its hash.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._schema = None
+        self._file_prompt = None
+        self._catalog_version = None
+        self._catalog_prompt = None
+
+    def _load_file(self):
+        # Reload schema.json only when its mtime changes
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self._mtime:
+            return
+        with open(self.path, "r") as f:
+            schema = validate_schema(json.load(f))
+        preamble = render_preamble(schema)
+        self._schema = schema
+        self._file_prompt = (preamble, hashlib.sha256(preamble.encode("utf-8")).hexdigest())
+        self._catalog_version = None
+        self._mtime = mtime
+        logger.info(f"Loaded schema from {self.path} with {len(schema['columns'])} columns")
+
+    def get(self):
+        """
+        Return (preamble, schema_hash) built from schema.json.
+        """
+        with self._lock:
+            self._load_file()
+            return self._file_prompt
+
+    def get_from_catalog(self, data_version, load_catalog_columns):
+        """
+        Return (preamble, schema_hash) built from the live table columns.
+        load_catalog_columns() returns [(column_name, data_type), ...] and is
+        only called when data_version changes.
+        """
+        with self._lock:
+            self._load_file()
+            if self._catalog_version != data_version or self._catalog_prompt is None:
+                schema = merge_catalog(self._schema, load_catalog_columns())
+                preamble = render_preamble(schema)
+                self._catalog_prompt = (preamble, hashlib.sha256(preamble.encode("utf-8")).hexdigest())
+                self._catalog_version = data_version
+            return self._catalog_prompt
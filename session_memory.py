@@ -0,0 +1,79 @@
+import threading
+from collections import OrderedDict, deque
+from typing import NamedTuple, Optional
+
+
+class Turn(NamedTuple):
+    content: str
+    is_user: bool
+    query_info: Optional[str]
+
+
+def last_exchange(turns):
+    """
+    Return (user_turn, ai_turn) for the most recent AI answer and the user
+    message it answered, from turns ordered oldest first.
+    """
+    for i in range(len(turns) - 1, -1, -1):
+        if not turns[i].is_user:
+            for j in range(i - 1, -1, -1):
+                if turns[j].is_user:
+                    return turns[j], turns[i]
+            return None, turns[i]
+    return None, None
+
+
+class SessionMemory:
+    """
+    Bounded in-process memory of the most recent turns of each chat session.
+
+    Holds at most max_turns turns for at most max_sessions sessions, evicting the
+    least recently used session. It is filled as messages are saved and from the
+    database on a miss. Each worker process has its own memory, so next to the
+    turns it keeps the timestamp of the newest message it knows of. A session
+    another worker wrote to since has a newer message in the database, and the
+    caller reloads it.
+    """
+
+    def __init__(self, max_sessions=1000, max_turns=6):
+        self.max_sessions = max_sessions
+        self.max_turns = max_turns
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        # (turns oldest first, timestamp of the newest message or None), None if the session isn't held
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            self._sessions.move_to_end(session_id)
+            turns, last_timestamp = entry
+            return list(turns), last_timestamp
+
+    def set(self, session_id, turns, last_timestamp=None):
+        if self.max_sessions <= 0:
+            return
+        with self._lock:
+            self._sessions[session_id] = (deque(turns, maxlen=self.max_turns), last_timestamp)
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def append(self, session_id, *turns, timestamp=None):
+        # Only extend sessions we already hold, a partial history would hide older turns
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is not None:
+                existing, last_timestamp = entry
+                existing.extend(turns)
+                if timestamp is not None and (last_timestamp is None or timestamp > last_timestamp):
+                    self._sessions[session_id] = (existing, timestamp)
+                self._sessions.move_to_end(session_id)
+
+    def clear(self, session_id=None):
+        with self._lock:
+            if session_id is None:
+                self._sessions.clear()
+            else:
+                self._sessions.pop(session_id, None)